@@ -15,7 +15,7 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
-import math, functools, threading
+import os, math, time, functools, itertools, threading, hashlib, collections, collections.abc, weakref, array
 
 try:
     from PyQt5 import QtCore, QtGui, QtWidgets
@@ -37,6 +37,15 @@ CURVES = [
     (translate("ImageFlow", "Gallery"), "gallery"),
 ]
 
+# Possible values for the 'cacheFormat' option and the corresponding image formats. 'auto' chooses the format
+# of pixmaps on the screen, so that caches need not be converted when they are drawn.
+CACHE_FORMATS = {
+    'rgb32':    QtGui.QImage.Format_RGB32,
+    'argb32pm': QtGui.QImage.Format_ARGB32_Premultiplied,
+    'rgb16':    QtGui.QImage.Format_RGB16,
+    'rgb888':   QtGui.QImage.Format_RGB888,
+}
+
 # Colors from which the user can choose in the configuration widget.
 COLORS = [
     (translate("ImageFlow", "Black"),      QtGui.QColor(0,0,0)),
@@ -55,7 +64,7 @@ OPTIONS = {
              "Maximal size of central image, e.g. 500x300. A single number can be used as shorthand for a "
              "square size."),
     'rotate': (bool, True,
-               "Rotate images according to EXIF-data (requires Wand, http://docs.wand-py.org/)."),
+               "Rotate images according to EXIF-data."),
     'imagesPerSide': (int, 5,
                       "Number of images visible to the left and right of the central image."),
     'background': (QtGui.QColor, Qt.black,
@@ -84,123 +93,997 @@ OPTIONS = {
     'reflectionAlpha': (float, 0.4,
                         "How good should the reflection be visible?"
                         "Between 0 (invisible) and 1 (visible like the original image)."),
+    'paintReflection': (bool, False,
+                        "Draw reflections while painting instead of storing them in the cached images. "
+                        "Changing options of the reflection is much faster then, but painting is slower."),
+    'mipmaps': (bool, False,
+                "Store downscaled versions of each cached image and use them to draw the images on the sides. "
+                "This makes painting faster and reduces aliasing, but needs one third more memory."),
     'fadeOut': (bool, False,
                 "Fade out images on both sides."),
     'fadeStart': (float, 0.4,
                   "Number in [0, 1]. If fadeOut is True, images will start fading out on both sides at the "
                   "position specified by fadeStart, i.e. 0 means that all images will fade out, 1 means that "
                   "only images at the outermost position will fade out."),
+    'threads': (int, 1,
+                "Number of threads used to load images. Use 0 to start one thread per processor core."),
+    'prefetch': (int, 3,
+                 "Maximal number of images beyond the visible ones which are loaded in advance in the "
+                 "direction of the animation. More images are loaded when the animation is faster."),
+    'previews': (bool, False,
+                 "While a JPEG image is loaded, show its embedded EXIF thumbnail (or a version decoded at "
+                 "low resolution). Images are loaded in the background only."),
+    'memoryLimit': (int, 0,
+                    "Maximal memory in MB used by cached and decoded images. When it is exceeded, images far "
+                    "away from the center are removed from memory and loaded again when necessary. "
+                    "0 means no limit."),
+    'timeBasedAnimation': (bool, False,
+                           "Move images according to the time that has actually elapsed instead of a fixed "
+                           "distance per frame. Animations keep their speed when painting is slow."),
+    'frameRate': (int, 0,
+                  "Frames per second of time based animations. 0 means the refresh rate of the screen."),
+    'diskCache': (str, '',
+                  "Directory where cached images are stored persistently, so that they need not be created "
+                  "again on the next start. Leave empty to disable the disk cache."),
+    'diskCacheSize': (int, 500,
+                      "Maximal size of the disk cache in MB. Least recently used images are removed first."),
+    'cacheFormat': (str, 'auto',
+                    "Pixel format of cached images. 'rgb16' and 'rgb888' need less memory (2 or 3 instead of "
+                    "4 bytes per pixel) at the cost of quality. 'auto' uses the native format of the screen. "
+                    "Possible values: 'auto',"+','.join("'{}'".format(key) for key in CACHE_FORMATS)),
 }
 
 # Options that, when changed, require cached images to be regenerated
-OPTIONS_REBUILD_CACHE = ['size', 'background', 'reflection', 'reflectionFactor', 'reflectionAlpha']
+OPTIONS_REBUILD_CACHE = ['size', 'rotate', 'background', 'reflection', 'reflectionFactor', 'reflectionAlpha',
+                         'paintReflection', 'mipmaps', 'cacheFormat']
+# Options in OPTIONS_REBUILD_CACHE that only affect the reflection. If 'paintReflection' is true, reflections
+# are not stored in the cache, so that changing these options does not require to rebuild caches.
+OPTIONS_REFLECTION = ['background', 'reflection', 'reflectionFactor', 'reflectionAlpha']
+
+
+def _rebuildOptions(options):
+    """Return the keys of those options which affect caches created using *options*."""
+    if options['paintReflection']:
+        return [key for key in OPTIONS_REBUILD_CACHE if key not in OPTIONS_REFLECTION]
+    else: return OPTIONS_REBUILD_CACHE
+
 
+# Tuple containing the formats of opaque and of transparent QPixmaps on the screen. Set by _detectPixmapFormats.
+_pixmapFormats = None
 
-# If this is set to true, the average drawing time will be measured and printed.
-DEBUG_TIMES = False
-if DEBUG_TIMES:
-    import time
-    _times = []
+def _detectPixmapFormats():
+    """Determine the formats in which QPixmaps store opaque and transparent images. On a 16 bit screen, for
+    example, opaque pixmaps use QImage.Format_RGB16. QPixmaps can only be created in the GUI thread, so this
+    must be called there (ImageFlowWidget does so when it is created)."""
+    global _pixmapFormats
+    if _pixmapFormats is None:
+        opaque = QtGui.QPixmap(1, 1)
+        opaque.fill(Qt.black)
+        transparent = QtGui.QPixmap(1, 1)
+        transparent.fill(Qt.transparent)
+        _pixmapFormats = (opaque.toImage().format(), transparent.toImage().format())
+
+
+def _cacheFormat(options):
+    """Return the QImage format for caches created using *options* (see option 'cacheFormat')."""
+    format = CACHE_FORMATS.get(options['cacheFormat'])
+    if format is not None:
+        return format
+    elif _pixmapFormats is not None and _pixmapFormats[0] in CACHE_FORMATS.values():
+        return _pixmapFormats[0]
+    else: return QtGui.QImage.Format_RGB32
+    
+    
+def _needsConversion(cache):
+    """Return whether *cache* is a QImage that should be converted into a QPixmap before it is drawn. QImages
+    in a format that QPixmap would change (e.g. Format_RGB16 on a 32 bit screen) are drawn directly, so that
+    they keep using less memory."""
+    return isinstance(cache, QtGui.QImage) and (_pixmapFormats is None or cache.format() in _pixmapFormats)
 
 
 # States of an image: Cache not created, cache successfully created, loading/cache creating failed.
 STATE_INIT, STATE_READY, STATE_FAILED = 1,2,3
+# Only a preliminary cache has been created from a thumbnail (option 'previews')
+STATE_PREVIEW = 4
 
 
 class Image:
     """A single image in the flow. This contains basically a QImage and the cached version of it (resized to
     ImageFlow.option('size') and with reflection added). Instead of submitting the image directly a path
-    may be given.
+    may be given. In this case self.image remains None unless load is called, and only as many pixels as
+    necessary for the cached version are decoded, so that full-resolution images are never kept in memory.
+    Use fullImage to read the image in full resolution when it is needed (e.g. for drag and drop).
+    Instead of a path, *data* may contain the encoded image in memory: a bytes-like object (e.g. bytes or
+    memoryview) or a tuple (mmap, offset, length). The data is decoded directly from the buffer without
+    copying it (note that an mmap cannot be closed while it is used by an Image).
+    Finally, images may be provided by a *loader* (see Loader). In this case the loader defines the meaning
+    of *path* (e.g. a URL).
     """
-    def __init__(self, path=None, image=None, text=None):
-        if path is None and image is None:
-            raise ValueError("Either path or image must be given")
+    # Downscaled versions of the cache (option 'mipmaps') are created until they are less wide than this
+    MIN_LEVEL_WIDTH = 16
+    __slots__ = ('state', 'path', 'data', 'loader', 'image', 'text', '_cache', '_levels', '_cacheOptions',
+                 '_reflection', '_generation', '_weakImage')
+    
+    def __init__(self, path=None, image=None, text=None, data=None, loader=None):
+        if path is None and image is None and data is None:
+            raise ValueError("Either path, image or data must be given")
+        if isinstance(data, tuple):
+            buffer, offset, length = data
+            data = memoryview(buffer)[offset:offset+length]
+        elif data is not None:
+            data = memoryview(data)
+            if data.format != 'B' or data.ndim != 1:
+                data = data.cast('B')
         self.state = STATE_INIT
         self.path = path
+        self.data = data
+        self.loader = loader
         self.image = image
         self.text = text
         self._cache = None
+        self._levels = [] # downscaled versions of the cache, see cacheLevel
+        self._cacheOptions = None # options used to create the cache
+        self._reflection = None # (weak reference to cache, reflectionFactor, reflection), see Renderer
+        self._generation = 0
+        self._weakImage = None # (rotate, weak reference) to the last image returned by fullImage
     
     def load(self, rotate=False):
-        """Load the image as QImage from filesystem."""
-        self.image = QtGui.QImage(self.path)
-        if rotate:
+        """Load the image as QImage from filesystem (or from self.data)."""
+        self.image = self.read(rotate)
+        
+    def fullImage(self, rotate=False):
+        """Return the image in full resolution as QImage. If self.image is None, the image is read from disk.
+        Images read by this method are only referenced weakly: They are released as soon as the caller does
+        not need them anymore, but are not read again as long as they are in use.
+        """
+        if self.image is not None:
+            return self.image
+        if self._weakImage is not None and self._weakImage[0] == rotate:
+            image = self._weakImage[1]()
+            if image is not None:
+                return image
+        image = self.read(rotate)
+        self._weakImage = (rotate, weakref.ref(image))
+        return image
+    
+    def read(self, rotate=False, size=None):
+        """Read the image from filesystem (or from self.data) and return it as QImage (without storing it in
+        self.image).
+        If *size* is given, the image will usually be decoded at a reduced resolution which is still large
+        enough to be scaled down to *size* (keeping the aspect ratio). This is much faster than decoding
+        the full image, in particular for large JPEG files. The full resolution is only decoded if *size*
+        is None.
+        """
+        data = self.data
+        if self.loader is not None:
+            # The data is released as soon as it has been decoded
             try:
-                import wand.image
-                w = wand.image.Image(filename=self.path)
-                if 'exif:Orientation' in w.metadata:
-                    orientation = w.metadata['exif:Orientation']
-                    if orientation != 1:
-                        # Rotations stuff (read from EXIF data)
-                        rotate = QtGui.QTransform()
-                        if orientation == "6":
-                            self.image = self.image.transformed(rotate.rotate(90))
-                        elif orientation == "8":
-                            self.image = self.image.transformed(rotate.rotate(270))
-                        elif orientation == "3":
-                            self.image = self.image.transformed(rotate.rotate(180))
-            except ImportError as e:
-                pass
-            except Exception as e:
+                data = self.loader.fetch(self)
+            except TemporaryLoadError:
+                raise # the image must not fail
+            except OSError as e:
                 print(e)
+                return QtGui.QImage()
+        orientation = self._orientation(data) if rotate else None
+        device = _BufferDevice(data) if data is not None else None # keep a reference while reading
+        reader = QtGui.QImageReader(device) if device is not None else QtGui.QImageReader(self.path)
+        if hasattr(reader, 'setAutoTransform'): # Qt >= 5.5; orientation is handled below
+            reader.setAutoTransform(False)
+        if size is not None and reader.supportsOption(QtGui.QImageIOHandler.ScaledSize):
+            fullSize = reader.size()
+            if fullSize.isValid():
+                if orientation in (5, 6, 7, 8):
+                    size = QtCore.QSize(size.height(), size.width())
+                targetSize = fullSize.scaled(size, Qt.KeepAspectRatio)
+                if bytes(reader.format()) in (b'jpeg', b'jpg'):
+                    # JPEG decoders can scale by 1/2, 1/4 and 1/8 during decoding (DCT scaling), which is
+                    # very fast. Use the smallest of these sizes that is not smaller than the target size.
+                    # The final, high-quality scaling is done by createCache.
+                    scaledSize = fullSize
+                    for denominator in (2, 4, 8):
+                        candidate = QtCore.QSize(-(-fullSize.width() // denominator),
+                                                 -(-fullSize.height() // denominator))
+                        if candidate.width() < targetSize.width() or candidate.height() < targetSize.height():
+                            break
+                        scaledSize = candidate
+                else: scaledSize = targetSize
+                if scaledSize.width() < fullSize.width():
+                    reader.setScaledSize(scaledSize)
+        image = reader.read()
+        if image.isNull() or orientation is None:
+            return image
+        return _orient(image, orientation)
+    
+    def _orientation(self, data=None):
+        """Return the value of the EXIF orientation tag of this image (1-8) or None if it is not
+        available. Only the header of the file (or of *data*, if the image is provided by a loader) is
+        read."""
+        try:
+            with self._open(data) as file:
+                return _exifOrientation(file)
+        except OSError:
+            return None
+        
+    def _open(self, data=None):
+        """Return a binary file object (which may be used as context manager) to read the encoded image
+        from *data*, self.data or its path."""
+        if data is None:
+            data = self.data
+        if data is not None:
+            return _BufferDevice(data)
+        else: return open(self.path, 'rb')
+    
+    def canReload(self):
+        """Return whether the image can be read again after self.image has been released, i.e. whether
+        a path (possibly for a loader) or data has been given."""
+        return self.path is not None or self.data is not None
        
-    def cache(self):
-        """Return the cached pixmap (resized to ImageFlow.option('size') and reflection added."""
-        if isinstance(self._cache, QtGui.QImage):
+    def cache(self, convert=True):
+        """Return the cached pixmap (resized to ImageFlow.option('size') and reflection added. If *convert* is
+        false and the cache has been created by the worker thread and not yet been converted (see
+        needsConversion), return a QImage instead."""
+        cache = self._cache
+        if convert and _needsConversion(cache):
             # Because the worker thread cannot create QPixmaps, it creates a QImage.
-            self._cache = QtGui.QPixmap(self._cache)
-        return self._cache
+            pixmap = QtGui.QPixmap.fromImage(cache)
+            if self._cache is cache: # the worker may have replaced the cache in the meantime
+                self._cache = pixmap
+            return pixmap
+        return cache
         
-    def createCache(self, options):
+    def cacheLevel(self, width, convert=True):
+        """Return the smallest of the cached pixmap and its downscaled versions (see option 'mipmaps') that is
+        at least *width* pixels wide. Drawing this pixmap with the given width is faster and looks smoother
+        than drawing the full cache. For *convert* see cache."""
+        levels = self._levels
+        for i in reversed(range(len(levels))):
+            level = levels[i]
+            if level.width() >= width:
+                if convert and _needsConversion(level):
+                    level = QtGui.QPixmap.fromImage(level)
+                    levels[i] = level # the worker always replaces the whole list
+                return level
+        return self.cache(convert)
+    
+    def needsConversion(self):
+        """Return whether the cache or one of its downscaled versions is still a QImage that will be converted
+        into a QPixmap (the worker thread cannot create QPixmaps)."""
+        return _needsConversion(self._cache) or any(_needsConversion(level) for level in self._levels)
+        
+    def convert(self):
+        """Convert the cache and all downscaled versions into QPixmaps. This must be called from the GUI
+        thread."""
+        self.cache()
+        levels = self._levels
+        for i, level in enumerate(levels):
+            if _needsConversion(level):
+                levels[i] = QtGui.QPixmap.fromImage(level)
+        
+    def createCache(self, options, diskCache=None, generation=0, metrics=None):
         """Create the cached version of this image using the specified options (from ImageFlow.options).
-        The cache version contains the resized image together with its reflection."""
-        if self.image is None:
-            self.load(options['rotate'])
-        if self.image.isNull():
-            self._cache = self.image
-            self.state = STATE_FAILED
+        The cache version contains the resized image together with its reflection. If a DiskCache is given,
+        it is used to avoid loading the image if possible and the created cache is stored in it.
+        *generation* is stored together with the cache. It is used by ImageFlowWidget to detect caches that
+        have been created with outdated options. The previous cache remains valid until the new one is
+        complete, so that it can still be displayed while this method runs in a worker thread.
+        If a Metrics-instance is given, decode and scale times and disk cache hits are recorded.
+        """
+        if self.loader is not None:
+            cacheKey = self.loader.cacheKey(self)
+            if cacheKey is None:
+                diskCache = None
+        elif self.path is None:
+            diskCache = None
+        else: cacheKey = None
+        if diskCache is not None:
+            cache = diskCache.get(self.path, options, cacheKey)
+            if metrics is not None:
+                metrics.count('diskCacheHits' if cache is not None else 'diskCacheMisses')
+            if cache is not None:
+                if cache.format() != _cacheFormat(options): # PNG files are always read as 32 bit images
+                    cache = cache.convertToFormat(_cacheFormat(options))
+                self._setCache(cache, options, generation, STATE_READY, self._createLevels(cache, options))
+                return
+            
+        image = self.image
+        if image is None:
+            # Only decode as many pixels as necessary; the full image is read again if it is needed.
+            if metrics is not None:
+                startTime = time.perf_counter()
+            image = self.read(options['rotate'], options['size'])
+            if metrics is not None:
+                metrics.record('decodeTime', (time.perf_counter() - startTime) * 1000)
+        if metrics is not None:
+            startTime = time.perf_counter()
+        if image.isNull():
+            self._setCache(image, options, generation, STATE_FAILED)
             return
+        cache = self._scale(image, options)
+        self._setCache(cache, options, generation, STATE_READY, self._createLevels(cache, options))
+        if metrics is not None:
+            metrics.record('scaleTime', (time.perf_counter() - startTime) * 1000)
+        if diskCache is not None:
+            diskCache.put(self.path, options, cache, cacheKey)
+    
+    def createPreview(self, options, generation=0):
+        """Create a preliminary cached version from the thumbnail embedded in the EXIF data of JPEG files
+        or, if there is none, from the image decoded at 1/8 of its resolution. This is only possible for
+        images in STATE_INIT that have been given by path or data (not by a loader). Return whether a preview
+        has been created. In this case the image is in STATE_PREVIEW until createCache is called.
+        """
+        if self.state != STATE_INIT or self.image is not None or self.loader is not None \
+                or not self.canReload():
+            return False
+        device = _BufferDevice(self.data) if self.data is not None else None # keep a reference while reading
+        reader = QtGui.QImageReader(device) if device is not None else QtGui.QImageReader(self.path)
+        if bytes(reader.format()) not in (b'jpeg', b'jpg'):
+            return False
+        try:
+            with self._open() as file:
+                orientation, thumbnail = _readExif(file, thumbnail=True)
+        except OSError:
+            return False
+        fullSize = reader.size()
+        image = QtGui.QImage.fromData(thumbnail) if thumbnail is not None else QtGui.QImage()
+        if not image.isNull() and fullSize.isValid():
+            # Thumbnails have a fixed size (usually 160x120) and may contain black bars. Crop them to the
+            # aspect ratio of the image.
+            w, h = image.width(), image.height()
+            if w * fullSize.height() > h * fullSize.width():
+                croppedW = max(1, round(h * fullSize.width() / fullSize.height()))
+                image = image.copy((w - croppedW) // 2, 0, croppedW, h)
+            else:
+                croppedH = max(1, round(w * fullSize.height() / fullSize.width()))
+                image = image.copy(0, (h - croppedH) // 2, w, croppedH)
+        if image.isNull():
+            if not fullSize.isValid():
+                return False
+            if hasattr(reader, 'setAutoTransform'):
+                reader.setAutoTransform(False)
+            reader.setScaledSize(QtCore.QSize(-(-fullSize.width() // 8), -(-fullSize.height() // 8)))
+            image = reader.read()
+            if image.isNull():
+                return False
+        if options['rotate'] and orientation is not None:
+            image = _orient(image, orientation)
+        self._setCache(self._scale(image, options), options, generation, STATE_PREVIEW)
+        return True
         
+    def _scale(self, image, options):
+        """Return the cached version of the QImage *image*: scaled to the option 'size' and with reflection
+        (unless the reflection is painted, see option 'paintReflection')."""
         w = options['size'].width()
         h = options['size'].height()
         
         # For some reason drawing the result of pixmap.scaled gives better results than doing the same
         # scaling directly when drawing (drawPixmap(QtCore.QRect(0,0,w,h), pixmap))
         # Setting the SmoothPixmapTransform rendering hint does not change this behavior.
-        image = self.image.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+        image = image.scaled(w, h, Qt.KeepAspectRatio, Qt.SmoothTransformation)
         w = image.width()
         h = image.height()
-        if options['reflection']:
+        if options['reflection'] and not options['paintReflection']:
             hRefl = int(h * options['reflectionFactor'])
         else: hRefl = 0
-        self._cache = QtGui.QImage(w, h + hRefl, QtGui.QImage.Format_RGB32)
-        painter = QtGui.QPainter(self._cache)
+        cache = QtGui.QImage(w, h + hRefl, _cacheFormat(options))
+        painter = QtGui.QPainter(cache)
         painter.drawImage(0, 0, image)
         
-        if options['reflection'] and options['reflectionAlpha'] > 0:
+        if hRefl > 0 and options['reflectionAlpha'] > 0:
             painter.setTransform(QtGui.QTransform(1, 0, 0, -1, 0, 0)) # draw reflection upside down
             source = QtCore.QRect(0, h-hRefl, w, hRefl)
             target = QtCore.QRect(0, -h-hRefl, w, hRefl)
-            painter.drawImage(target, self._cache, source)
+            painter.drawImage(target, cache, source)
             painter.resetTransform()
             
             gradient = QtGui.QLinearGradient(0, 0, 0, 1)
             gradient.setCoordinateMode(QtGui.QGradient.ObjectBoundingMode)
             color = QtGui.QColor(options['background'])
-            color.setAlpha((1.-options['reflectionAlpha'])*255)
+            color.setAlpha(round((1.-options['reflectionAlpha'])*255))
             gradient.setColorAt(0, color)
             gradient.setColorAt(1, options['background'])
             painter.fillRect(0, h, w, hRefl, gradient)
         painter.end()
-        self.state = STATE_READY
+        return cache
+    
+    def _createLevels(self, cache, options):
+        """Return a list of downscaled versions of *cache*, each half as large as the previous one, if the
+        option 'mipmaps' is set. Otherwise return an empty list."""
+        levels = []
+        if options['mipmaps']:
+            level = cache
+            while level.width() >= 2 * self.MIN_LEVEL_WIDTH:
+                level = level.scaled(level.width() // 2, level.height() // 2,
+                                     Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+                if level.format() != cache.format(): # smooth scaling returns 32 bit images
+                    level = level.convertToFormat(cache.format())
+                levels.append(level)
+        return levels
+        
+    def _setCache(self, cache, options, generation, state, levels=()):
+        """Replace the cached version by *cache*, which has been created using *options*. *levels* are
+        the downscaled versions of *cache* (see _createLevels)."""
+        self._levels = list(levels)
+        self._cacheOptions = options
+        self._cache = cache
+        self._generation = generation
+        self.state = state
+        
+    def hasReflection(self):
+        """Return whether the cached version contains a reflection."""
+        return self._cacheOptions is not None and self._cacheOptions['reflection'] \
+                    and not self._cacheOptions['paintReflection']
+    
+    def hasCache(self):
+        """Return whether a cached version (possibly a preview or outdated) exists that can be drawn."""
+        return self.state in (STATE_READY, STATE_PREVIEW)
     
+    def needsCache(self, generation):
+        """Return whether createCache must be called for this image, because it has not been loaded yet, only
+        a preview exists or the cache is outdated (see isOutdated)."""
+        return self.state in (STATE_INIT, STATE_PREVIEW) or self.isOutdated(generation)
+    
+    def isOutdated(self, generation):
+        """Return whether the cached version exists but has been created for a different generation of
+        options than *generation* (see createCache)."""
+        return self.state == STATE_READY and self._generation != generation
+    
+    def memoryUsage(self):
+        """Return the approximate number of bytes used by the cached version and the decoded image."""
+        size = _imageBytes(self._cache) + _imageBytes(self.image)
+        size += sum(_imageBytes(level) for level in self._levels)
+        if self._reflection is not None:
+            size += _imageBytes(self._reflection[2])
+        return size
+    
+    def unload(self):
+        """Delete the cached version and, if the image can be loaded again from its path or data, the decoded
+        image. The image returns to STATE_INIT and will be loaded again when necessary."""
+        self._clearCache()
+        if self.canReload():
+            self.image = None
+        
     def _clearCache(self):
-        """Delete the cached version. Use this whenever options which affect the cached version have changed.
-        """
+        """Delete the cached version."""
         self.state = STATE_INIT
         self._cache = None
+        self._levels = []
+        self._cacheOptions = None
+        self._reflection = None
+
+
+class _BufferDevice(QtCore.QIODevice):
+    """Read-only QIODevice for a bytes-like object (see Image). Decoders read the data in small chunks, so
+    that the buffer is never copied as a whole. It also provides the methods of a binary file object
+    that are used by _readExif."""
+    def __init__(self, buffer):
+        super().__init__()
+        self._buffer = buffer
+        self.open(QtCore.QIODevice.ReadOnly)
+        
+    def isSequential(self):
+        return False
+    
+    def size(self):
+        return len(self._buffer)
+    
+    def readData(self, maxSize):
+        position = self.pos()
+        return bytes(self._buffer[position:position+maxSize])
+    
+    def writeData(self, data):
+        return -1
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
+    
+    
+def _exifOrientation(file):
+    """Return the value of the EXIF orientation tag (1-8) of the JPEG or TIFF image in the given binary
+    file object or None if the image does not contain a valid orientation. Only the headers are read:
+    JPEG segments before the EXIF data are skipped and parsing stops at the image data."""
+    return _readExif(file)[0]
+
+
+def _readExif(file, thumbnail=False):
+    """Return a tuple (orientation, thumbnail) for the JPEG or TIFF image in the given binary file object.
+    See _exifOrientation for the orientation. If *thumbnail* is true, the second value contains the
+    encoded JPEG thumbnail embedded in the EXIF data (or None if there is none). Otherwise it is None."""
+    try:
+        header = file.read(4)
+        if header in (b'II*\0', b'MM\0*'):
+            return _readTiff(file, 0, False) # thumbnails in TIFF files are not supported
+        if header[:2] != b'\xff\xd8':
+            return None, None
+        position = 2
+        while True:
+            file.seek(position)
+            segment = file.read(4)
+            if len(segment) < 4 or segment[0] != 0xFF:
+                return None, None
+            marker, length = segment[1], int.from_bytes(segment[2:], 'big')
+            if marker == 0xE1 and file.read(6) == b'Exif\0\0':
+                return _readTiff(file, position + 10, thumbnail)
+            elif marker in (0xDA, 0xD9): # start of scan or end of image: no more metadata
+                return None, None
+            position += 2 + length
+    except (OSError, ValueError):
+        return None, None
+
+    
+def _readTiff(file, base, thumbnail):
+    """Return orientation and thumbnail (see _readExif) from the TIFF structure starting at position *base*
+    in the given binary file object. The orientation is stored in the first IFD, the thumbnail in the
+    second one."""
+    file.seek(base)
+    header = file.read(8)
+    if header[:4] == b'II*\0':
+        byteOrder = 'little'
+    elif header[:4] == b'MM\0*':
+        byteOrder = 'big'
+    else: return None, None
+    
+    def readIfd(offset):
+        """Return a dict mapping tags of the IFD at *offset* to their (first) value and the offset of the
+        next IFD."""
+        file.seek(base + offset)
+        count = int.from_bytes(file.read(2), byteOrder)
+        entries = file.read(12 * count)
+        values = {}
+        for i in range(0, len(entries) - 11, 12):
+            tag = int.from_bytes(entries[i:i+2], byteOrder)
+            if int.from_bytes(entries[i+2:i+4], byteOrder) == 3: # SHORT
+                values[tag] = int.from_bytes(entries[i+8:i+10], byteOrder)
+            else: values[tag] = int.from_bytes(entries[i+8:i+12], byteOrder)
+        return values, int.from_bytes(file.read(4), byteOrder)
+        
+    values, nextOffset = readIfd(int.from_bytes(header[4:8], byteOrder))
+    orientation = values.get(0x0112) # Orientation
+    if orientation is not None and not 1 <= orientation <= 8:
+        orientation = None
+    data = None
+    if thumbnail and nextOffset > 0:
+        values, _ = readIfd(nextOffset)
+        offset, length = values.get(0x0201), values.get(0x0202) # JPEGInterchangeFormat(Length)
+        if offset is not None and length is not None and length > 0:
+            file.seek(base + offset)
+            data = file.read(length)
+            if len(data) < length or data[:2] != b'\xff\xd8':
+                data = None
+    return orientation, data
+
+
+def _orient(image, orientation):
+    """Return a copy of the QImage *image* transformed for display according to the EXIF orientation
+    value *orientation* (1-8)."""
+    if orientation in (5, 6, 7, 8):
+        # Rotate by 90° clockwise (6) or counterclockwise (8). For 5 and 7 the image is mirrored
+        # additionally, i.e. it is transposed or transversed.
+        image = image.transformed(QtGui.QTransform().rotate(270 if orientation == 8 else 90))
+    if orientation in (2, 5):
+        image = image.mirrored(True, False)
+    elif orientation in (4, 7):
+        image = image.mirrored(False, True)
+    elif orientation == 3:
+        image = image.transformed(QtGui.QTransform().rotate(180))
+    return image
+    
+    
+class LoadCancelled(Exception):
+    """Raised by Loader.fetch if loading an image has been cancelled (see Loader.request)."""
+    
+    
+class TemporaryLoadError(OSError):
+    """Raised by Loader.fetch if an image cannot be loaded for a reason that may go away, e.g. a timeout or a
+    server error. Contrary to other OSErrors, the image does not fail but remains in STATE_INIT and is loaded
+    again later (see Worker.RETRY_DELAY)."""
+    
+    
+class Loader:
+    """Base class for loaders that provide the encoded data of images which are not stored in local files
+    (e.g. on a web server). Such images are created with Image(path, loader=loader), where the meaning of
+    *path* is defined by the loader. Loaders are used by the GUI thread and the worker threads at the same
+    time, so subclasses must be thread-safe. See imageflow.loaders for implementations.
+    """
+    def fetch(self, image):
+        """Return the encoded data of *image* as bytes-like object. This method is called from worker threads
+        and may block. Raise TemporaryLoadError if the data cannot be loaded at the moment, OSError if it
+        cannot be loaded at all and LoadCancelled if loading has been cancelled (see request)."""
+        raise NotImplementedError()
+    
+    def request(self, images):
+        """This method is called by the Worker whenever its load list changes: *images* contains the images
+        of this loader that will be loaded next (most important first). Loaders may start fetching them in
+        advance and cancel fetches of all other images. The default implementation does nothing."""
+        pass
+    
+    def cacheKey(self, image):
+        """Return a string that identifies *image* (and its current version) in the DiskCache or None if
+        the disk cache should not be used for this image. The default implementation returns None."""
+        return None
+    
+    def close(self):
+        """Release all resources (e.g. connections) held by this loader."""
+        pass
+    
+    
+class ImageList(collections.abc.Sequence):
+    """A sequence of images for large collections (see ImageFlowWidget.setPaths). Instead of Image-instances
+    only the paths (and optionally texts and a Loader used for all images) are stored. Image-instances are created when they are accessed
+    and released by the Renderer when they are far away from the current position (see release).
+    The state of released images is stored in an array, so that images that failed to load are not
+    loaded again.
+    """
+    # release removes Image-instances only if more than this number of instances exists
+    MAX_IMAGES = 500
+    
+    def __init__(self, paths, texts=None, loader=None):
+        self.paths = paths
+        self.texts = texts
+        self.loader = loader
+        self._images = {} # maps indexes to existing Image-instances
+        self._states = array.array('b', bytes(len(paths))) # 0 or STATE_FAILED for released images
+        
+    def __len__(self):
+        return len(self.paths)
+    
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        image = self._images.get(index)
+        if image is None:
+            if not 0 <= index < len(self):
+                raise IndexError("ImageList index out of range")
+            image = Image(path=self.paths[index], text=self.texts[index] if self.texts is not None else None,
+                          loader=self.loader)
+            if self._states[index] == STATE_FAILED:
+                image.state = STATE_FAILED
+            self._images[index] = image
+        return image
+    
+    def imageCount(self):
+        """Return the number of Image-instances that currently exist."""
+        return len(self._images)
+    
+    def insertPaths(self, index, paths, texts=None):
+        """Insert images with the given paths (and optionally texts) before *index*."""
+        paths = list(paths)
+        n = len(paths)
+        self._images = {i + n if i >= index else i: image for i, image in self._images.items()}
+        self.paths[index:index] = paths
+        if texts is not None and self.texts is None:
+            self.texts = [None] * (len(self.paths) - n)
+        if self.texts is not None:
+            self.texts[index:index] = list(texts) if texts is not None else [None] * n
+        self._states[index:index] = array.array('b', bytes(n))
+        
+    def insertImages(self, index, images):
+        """Insert the given Image-instances before *index*. Instances that use another loader than this list
+        or that have data are kept as long as they are contained in the list (see release)."""
+        self.insertPaths(index, [image.path for image in images],
+                         [image.text for image in images] if any(image.text is not None for image in images)
+                         else None)
+        for i, image in enumerate(images):
+            self._images[index+i] = image
+            
+    def removeImages(self, index, count):
+        """Remove *count* images starting at *index*."""
+        stop = index + count
+        self._images = {i - count if i >= stop else i: image for i, image in self._images.items()
+                        if not index <= i < stop}
+        del self.paths[index:stop]
+        if self.texts is not None:
+            del self.texts[index:stop]
+        del self._states[index:stop]
+        
+    def moveImages(self, index, count, target):
+        """Move *count* images starting at *index*, so that they start at *target* afterwards. Like
+        removeImages this does not create Image-instances."""
+        stop = index + count
+        paths = self.paths[index:stop]
+        texts = self.texts[index:stop] if self.texts is not None else None
+        states = self._states[index:stop]
+        images = {i - index: image for i, image in self._images.items() if index <= i < stop}
+        self.removeImages(index, count)
+        self.insertPaths(target, paths, texts)
+        self._states[target:target+count] = states
+        for offset, image in images.items():
+            self._images[target+offset] = image
+        
+    def existingImages(self, start, stop):
+        """Return the Image-instances that currently exist for indexes in range(start, stop)."""
+        return [image for index, image in self._images.items() if start <= index < stop]
+        
+    def release(self, keep):
+        """Release all Image-instances (including their caches) whose index is not contained in the range
+        *keep*, if there are more than MAX_IMAGES instances. Return the list of released images. Images
+        that cannot be created again from their path and self.loader (e.g. images inserted with a different
+        loader or with data, see insertImages) are never released."""
+        if len(self._images) <= self.MAX_IMAGES:
+            return []
+        released = []
+        for index in [index for index, image in self._images.items()
+                      if index not in keep and image.path is not None and image.data is None
+                      and image.loader is self.loader]:
+            image = self._images.pop(index)
+            if image.state == STATE_FAILED:
+                self._states[index] = STATE_FAILED
+            released.append(image)
+        return released
+    
+    
+class Metrics:
+    """Collects performance data of an ImageFlowWidget (see ImageFlowWidget.setMetrics). Three kinds of data
+    are collected:
+        - samples, e.g. 'paintTime' (ms needed to render a frame), 'decodeTime' and 'scaleTime' (ms needed
+          to decode an image and to create its cache), 'queueDepth' (number of images the worker has to
+          load). Only the last MAX_SAMPLES values of each kind are kept.
+        - counters, e.g. 'cacheHits' and 'cacheMisses' (visible images that were or were not drawn from
+          the cache, counted in each frame), 'diskCacheHits' and 'diskCacheMisses'.
+        - values, e.g. 'cacheMemory' (bytes used by cached images, see CacheManager).
+    If *callback* is given, it is called with the name and value of each sample and value, e.g. to feed
+    them into other monitoring systems. Note that the callback is also called from worker threads.
+    This class is thread-safe. If no Metrics-instance is installed, no data is collected at all.
+    """
+    MAX_SAMPLES = 1000
+    
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._lock = threading.Lock()
+        self.reset()
+        
+    def reset(self):
+        """Delete all collected data."""
+        with self._lock:
+            self._samples = collections.defaultdict(lambda: collections.deque(maxlen=self.MAX_SAMPLES))
+            self._counters = collections.Counter()
+            self._values = {}
+        
+    def record(self, name, value):
+        """Record a sample for the given name."""
+        with self._lock:
+            self._samples[name].append(value)
+        if self.callback is not None:
+            self.callback(name, value)
+            
+    def count(self, name, n=1):
+        """Increase the counter with the given name by *n*."""
+        with self._lock:
+            self._counters[name] += n
+            
+    def setValue(self, name, value):
+        """Set the current value for the given name."""
+        with self._lock:
+            self._values[name] = value
+        if self.callback is not None:
+            self.callback(name, value)
+        
+    def percentile(self, name, percent):
+        """Return the given percentile (0-100) of the samples recorded for *name* or None if there are
+        no samples."""
+        with self._lock:
+            samples = sorted(self._samples[name]) if name in self._samples else []
+        if len(samples) == 0:
+            return None
+        return samples[min(len(samples)-1, max(0, math.ceil(percent / 100 * len(samples)) - 1))]
+    
+    def summary(self):
+        """Return a dict containing all collected data: For each kind of samples, a dict with the keys
+        'count', 'mean', 'p50', 'p90', 'p99' and 'max'. For each counter and value its current value.
+        Additionally 'cacheHitRate' if cache hits or misses have been counted."""
+        with self._lock:
+            samples = {name: sorted(values) for name, values in self._samples.items() if len(values) > 0}
+            result = dict(self._counters)
+            result.update(self._values)
+        for name, values in samples.items():
+            def percentile(percent):
+                return values[min(len(values)-1, max(0, math.ceil(percent / 100 * len(values)) - 1))]
+            result[name] = {'count': len(values), 'mean': sum(values) / len(values),
+                            'p50': percentile(50), 'p90': percentile(90), 'p99': percentile(99),
+                            'max': values[-1]}
+        total = result.get('cacheHits', 0) + result.get('cacheMisses', 0)
+        if total > 0:
+            result['cacheHitRate'] = result.get('cacheHits', 0) / total
+        return result
+    
+    
+def _imageBytes(image):
+    """Return the approximate number of bytes used by the given QImage or QPixmap (which may be None)."""
+    if image is None:
+        return 0
+    return image.width() * image.height() * image.depth() // 8
 
 
+class CacheManager:
+    """Keeps track of the memory used by images and removes their cached versions (see Image.unload) when
+    the total exceeds *maxSize* bytes (0 means no limit). Images far away from the current position are
+    removed first, images at the same distance in least recently used order. This class must only be used
+    from the GUI thread.
+    """
+    def __init__(self, maxSize=0):
+        self.maxSize = maxSize
+        self._entries = collections.OrderedDict() # maps images to [index, size], least recently used first
+        self._size = 0
+        
+    def size(self):
+        """Return the number of bytes used by all images known to the manager."""
+        return self._size
+    
+    def touch(self, image, index):
+        """Register that *image*, which is at the given index in ImageFlowWidget.images, has been used."""
+        size = image.memoryUsage()
+        entry = self._entries.get(image)
+        if entry is None:
+            self._entries[image] = [index, size]
+            self._size += size
+        else:
+            self._size += size - entry[1]
+            entry[0] = index
+            entry[1] = size
+            self._entries.move_to_end(image)
+            
+    def remove(self, image):
+        """Forget about *image* (e.g. because its cache has been cleared)."""
+        entry = self._entries.pop(image, None)
+        if entry is not None:
+            self._size -= entry[1]
+            
+    def clear(self):
+        """Forget about all images."""
+        self._entries.clear()
+        self._size = 0
+        
+    def remap(self, mapIndex):
+        """Update the indexes of all images after ImageFlowWidget.images has changed. *mapIndex* maps
+        old indexes to new ones or to None for removed images."""
+        for entry in self._entries.values():
+            index = mapIndex(entry[0])
+            if index is not None:
+                entry[0] = index
+            
+    def shrink(self, position, keep, busy=()):
+        """Unload images until the total size fits into self.maxSize. *position* is the current position of
+        the ImageFlowWidget, *keep* is a range of indexes of images that must not be unloaded. Images in
+        *busy* are currently loaded by the worker (see Worker.busyImages) and are not unloaded either:
+        Their new cache would not be tracked by the manager."""
+        if self.maxSize <= 0 or self._size <= self.maxSize:
+            return
+        ranks = {image: rank for rank, image in enumerate(self._entries)}
+        images = sorted(self._entries,
+                        key=lambda image: (-abs(self._entries[image][0]-position), ranks[image]))
+        for image in images:
+            if self._size <= self.maxSize:
+                break
+            if self._entries[image][0] in keep or image in busy:
+                continue
+            self.remove(image)
+            if image.state != STATE_INIT: # otherwise the worker may be loading it right now
+                image.unload()
+            
+
+class DiskCache:
+    """Persistent storage for the cached versions of images (see Image.createCache) in the given *directory*.
+    Files are identified by the path, modification time and size of the original image (or by a key given
+    by a Loader, see Loader.cacheKey) and by the values of all options in OPTIONS_REBUILD_CACHE (e.g. 'rotate',
+    because it changes the stored pixels). When the total size exceeds *maxSize* bytes, the least recently
+    used files are removed. Methods of this class may be called from several threads.
+    """
+    def __init__(self, directory, maxSize):
+        self.directory = directory
+        self.maxSize = maxSize
+        self._lock = threading.Lock()
+        self._files = collections.OrderedDict() # maps file names to sizes, least recently used first
+        self._size = 0
+        os.makedirs(directory, exist_ok=True)
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith('.png') and entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries): # get() and put() update mtime on each access
+            self._files[name] = size
+            self._size += size
+        with self._lock:
+            self._shrink()
+        
+    def setMaxSize(self, maxSize):
+        """Change the maximal size of the cache (in bytes) and remove files if necessary."""
+        with self._lock:
+            self.maxSize = maxSize
+            self._shrink()
+        
+    def get(self, path, options, key=None):
+        """Return the cached version of the image at *path* created using *options* as QImage. Return None
+        if the cache does not contain such an image. If *key* is given, it identifies the image instead of
+        the path."""
+        name = self._fileName(path, options, key)
+        if name is None:
+            return None
+        with self._lock:
+            if name not in self._files:
+                return None
+            self._files.move_to_end(name)
+        filePath = os.path.join(self.directory, name)
+        image = QtGui.QImage(filePath)
+        if image.isNull():
+            with self._lock:
+                if name in self._files:
+                    self._size -= self._files.pop(name)
+            return None
+        try:
+            os.utime(filePath)
+        except OSError:
+            pass
+        return image
+    
+    def contains(self, path, options, key=None):
+        """Return whether the cache contains the cached version of the image at *path* (or identified by
+        *key*) created using *options*."""
+        name = self._fileName(path, options, key)
+        with self._lock:
+            return name is not None and name in self._files
+        
+    def put(self, path, options, image, key=None):
+        """Store the QImage *image*, which is the cached version of the image at *path* (or identified by
+        *key*) created using *options*."""
+        name = self._fileName(path, options, key)
+        if name is None:
+            return
+        filePath = os.path.join(self.directory, name)
+        tempPath = '{}.{}.tmp'.format(filePath, threading.get_ident())
+        try:
+            # Write to a temporary file first, so that other threads/processes never read incomplete files.
+            if not image.save(tempPath, 'PNG'):
+                return
+            os.replace(tempPath, filePath)
+            size = os.path.getsize(filePath)
+        except OSError as e:
+            print(e)
+            return
+        with self._lock:
+            self._size += size - self._files.get(name, 0)
+            self._files[name] = size
+            self._files.move_to_end(name)
+            self._shrink()
+    
+    def _shrink(self):
+        """Remove least recently used files until the cache fits into self.maxSize. The most recently used file
+        is never removed. The lock must be held when calling this method."""
+        while self._size > self.maxSize and len(self._files) > 1:
+            name, size = self._files.popitem(last=False)
+            self._size -= size
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
+                pass
+    
+    def _fileName(self, path, options, key=None):
+        """Return the file name used to store the image at *path* (or identified by *key*) created using
+        *options* or None if *path* cannot be accessed."""
+        if key is not None:
+            key = ['key', key]
+        else:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                return None
+            key = [os.path.abspath(path), stat.st_mtime_ns, stat.st_size]
+        for option in _rebuildOptions(options):
+            value = options[option]
+            if OPTIONS[option][0] is QtGui.QColor:
+                value = QtGui.QColor(value).rgba() # the default value is a Qt.GlobalColor
+            elif option == 'cacheFormat':
+                value = int(_cacheFormat(options)) # 'auto' depends on the screen
+            elif isinstance(value, QtCore.QSize):
+                value = (value.width(), value.height())
+            key.append(value)
+        return hashlib.sha1(repr(key).encode('utf-8')).hexdigest() + '.png'
+        
+
 class ImageFlowWidget(QtWidgets.QWidget):
     """The widget that contains the image flow. Arguments:
         - data: Load state from a dict generated by saveState.
@@ -220,15 +1103,22 @@ class ImageFlowWidget(QtWidgets.QWidget):
         self.setFocusPolicy(Qt.WheelFocus)
         
         self.renderer = self.animator = self.worker = None
+        _detectPixmapFormats()
         
         self.images = []
         self._pos = 0     
         self._o = {option: default for option, (optionType, default, _) in OPTIONS.items()}
+        self._generation = 0 # increased whenever an option in OPTIONS_REBUILD_CACHE changes
+        self.diskCache = None
+        self.cacheManager = CacheManager()
+        self.metrics = None
         if data is not None:
             self.loadData(data)
         
         if loadAsync:
-            self.worker = Worker(self._o, self) # use the same dict, so worker always uses current options
+            self.worker = Worker(self._o.copy(), self)
+            self.worker.setOptions(self._o.copy(), self._generation)
+            self.worker.diskCache = self.diskCache
             self.worker.start()
         self.renderer = Renderer(self)
         self.animator = Animator(self)
@@ -265,14 +1155,39 @@ class ImageFlowWidget(QtWidgets.QWidget):
             if value != self._o[key]:    
                 self._o[key] = value
                 changed.append(key)
-        if any(k in OPTIONS_REBUILD_CACHE for k in changed):
-            if self.worker is not None:
-                self.worker.reset()
-            for image in self.images:
-                image._clearCache()
+        if 'diskCache' in changed or 'diskCacheSize' in changed:
+            self._updateDiskCache()
+        if any(k in _rebuildOptions(self._o) for k in changed):
+            # Caches are rebuilt in the background. Until then, the outdated caches are displayed.
+            self._generation += 1
+        if len(changed) and self.worker is not None:
+            self.worker.setOptions(self._o.copy(), self._generation)
+            if 'threads' in changed:
+                self.worker.updateThreads()
+        if 'memoryLimit' in changed:
+            self.cacheManager.maxSize = self._o['memoryLimit'] * 1024 * 1024
         if len(changed) and self.renderer is not None:
             self.triggerRender()
     
+    def setMetrics(self, metrics):
+        """Install a Metrics-instance that will collect performance data of this widget. Use None to stop
+        collecting data."""
+        self.metrics = metrics
+        if self.worker is not None:
+            self.worker.metrics = metrics
+            
+    def _updateDiskCache(self):
+        """Create, resize or remove the DiskCache according to the options 'diskCache' and 'diskCacheSize'."""
+        directory = self._o['diskCache']
+        maxSize = self._o['diskCacheSize'] * 1024 * 1024
+        if not directory:
+            self.diskCache = None
+        elif self.diskCache is None or self.diskCache.directory != directory:
+            self.diskCache = DiskCache(directory, maxSize)
+        else: self.diskCache.setMaxSize(maxSize)
+        if self.worker is not None:
+            self.worker.diskCache = self.diskCache
+    
     def saveData(self):
         """Return a dict that stores the configuration of this widget using only standard data types. Use 
         this to save configuration persistently."""
@@ -303,23 +1218,141 @@ class ImageFlowWidget(QtWidgets.QWidget):
         """Return the number of images."""
         return len(self.images)
        
-    def setPaths(self, paths):
-        """Display the images at the given paths."""
-        self.setImages([Image(path=path) for path in paths])
+    def setPaths(self, paths, texts=None, loader=None):
+        """Display the images at the given paths (optionally with the given texts). Image-instances are
+        only created for images near the current position (see ImageList). If a Loader is given, it is used
+        to load all images and defines the meaning of the paths."""
+        self.setImages(ImageList(list(paths), list(texts) if texts is not None else None, loader))
        
     def setQImages(self, images):
         """Display the given QImages."""
         self.setImages([Image(image=image) for image in images])
         
     def setImages(self, images):
-        """Display the given imageflow.Image-instances."""
+        """Display the given imageflow.Image-instances (a list or an ImageList)."""
         self.animator.stop()
         self.images = images
+        self.cacheManager.clear()
+        self.renderer._requested = {}
         self._pos = None
         if len(images) > 0:
             self.setPosition(min(len(self.images)//2, self._o['imagesPerSide']))
         else: self.triggerRender()
          
+    def insertPaths(self, index, paths, texts=None):
+        """Insert images with the given paths (and optionally texts) before *index*. See insertImages. If the
+        widget is empty, an ImageList is used (as in setPaths), so that Image-instances are only created for
+        images near the current position."""
+        if len(self.images) == 0 and not isinstance(self.images, ImageList):
+            self.images = ImageList([])
+        if isinstance(self.images, ImageList):
+            index = max(0, min(index, len(self.images)))
+            self._changeImages(index, len(paths), lambda: self.images.insertPaths(index, paths, texts))
+        else:
+            self.insertImages(index, [Image(path=path, text=text)
+                                      for path, text in zip(paths, texts or itertools.repeat(None))])
+        
+    def appendPaths(self, paths, texts=None):
+        """Append images with the given paths (and optionally texts). See insertImages."""
+        self.insertPaths(len(self.images), paths, texts)
+        
+    def insertImages(self, index, images):
+        """Insert the given imageflow.Image-instances before *index*. Contrary to setImages, the caches of
+        all images are kept and the current image remains in the center."""
+        images = list(images)
+        index = max(0, min(index, len(self.images)))
+        if isinstance(self.images, ImageList):
+            change = lambda: self.images.insertImages(index, images)
+        else:
+            def change():
+                self.images[index:index] = images
+        self._changeImages(index, len(images), change)
+        
+    def appendImages(self, images):
+        """Append the given imageflow.Image-instances. See insertImages."""
+        self.insertImages(len(self.images), images)
+        
+    def removeImages(self, index, count=1):
+        """Remove *count* images starting at *index*. If the current image is removed, the image after the
+        removed ones (or the last image) becomes the current image."""
+        index = max(0, min(index, len(self.images)))
+        count = max(0, min(count, len(self.images)-index))
+        if isinstance(self.images, ImageList):
+            # Only existing instances can have a cache; do not create the others
+            removed = self.images.existingImages(index, index+count)
+            change = lambda: self.images.removeImages(index, count)
+        else:
+            removed = self.images[index:index+count]
+            def change():
+                del self.images[index:index+count]
+        for image in removed:
+            self.cacheManager.remove(image)
+        self._changeImages(index, -count, change)
+        
+    def moveImages(self, index, count, target):
+        """Move *count* images starting at *index*, so that they start at *target* afterwards. If the
+        current image is moved, it remains the current image."""
+        index = max(0, min(index, len(self.images)))
+        count = max(0, min(count, len(self.images)-index))
+        target = max(0, min(target, len(self.images)-count))
+        if count == 0 or target == index:
+            return
+        if isinstance(self.images, ImageList):
+            change = lambda: self.images.moveImages(index, count, target)
+        else:
+            images = self.images[index:index+count]
+            def change():
+                del self.images[index:index+count]
+                self.images[target:target] = images
+                
+        def mapIndex(i):
+            if index <= i < index+count:
+                return target + i - index
+            if i >= index+count:
+                i -= count
+            return i + count if i >= target else i
+        self._changeImages(min(index, target), 0, change, mapIndex)
+        
+    def _changeImages(self, index, delta, change, mapIndex=None):
+        """Call *change* which inserts (*delta* > 0) or removes (*delta* < 0) images at *index* in
+        self.images and update all indexes stored in this widget accordingly. *mapIndex* may be used to
+        specify a different mapping from old to new indexes. The current image remains in the center
+        (unless it has been removed) and images are only rendered again if they have been affected."""
+        if delta == 0 and mapIndex is None:
+            return
+        if mapIndex is None:
+            if delta > 0:
+                mapIndex = lambda i: i + delta if i >= index else i
+            else: mapIndex = lambda i: None if index <= i < index-delta else (i + delta if i >= index else i)
+        if self._pos is None or len(self.images) == 0:
+            change()
+            self.setImages(self.images) # nothing to keep
+            return
+        
+        current = round(self._pos)
+        change()
+        count = len(self.images)
+        if count == 0:
+            self.setImages(self.images)
+            return
+        
+        newCurrent = mapIndex(current)
+        if newCurrent is None:
+            self._pos = min(index, count-1)
+        else: self._pos = max(0, min(self._pos + newCurrent - current, count-1))
+        target = self.animator._target
+        if target is not None:
+            newTarget = mapIndex(target)
+            self.animator._target = min(index, count-1) if newTarget is None else min(newTarget, count-1)
+        self.cacheManager.remap(mapIndex)
+        self.renderer._requested = {image: mapIndex(i) for image, i in self.renderer._requested.items()
+                                    if mapIndex(i) is not None}
+        start, _, stop = self.renderer.layout.visibleRange()
+        if index < stop:
+            self.triggerRender()
+        if round(self._pos) != current:
+            self.indexChanged.emit(round(self._pos))
+        
     def clear(self):
         """Remove all images from display."""
         self.setImages([])
@@ -369,10 +1402,15 @@ class ImageFlowWidget(QtWidgets.QWidget):
             self.triggerRender()
             self.indexChanged.emit(position)
         
-    def triggerRender(self):
-        """Schedule a repaint."""
-        self.renderer.dirty = True
-        self.update()
+    def triggerRender(self, region=None):
+        """Schedule a repaint. If *region* (a QRegion) is given, only this part of the widget will be
+        rendered again. Otherwise everything is rendered again."""
+        if region is None:
+            self.renderer.dirty = True
+            self.update()
+        elif not region.isEmpty():
+            self.renderer.damage = self.renderer.damage.united(region)
+            self.update(region)
         
     def createConfigWidget(self, parent):
         """Return a widget that allows to configure this ImageFlow."""
@@ -391,16 +1429,12 @@ class ImageFlowWidget(QtWidgets.QWidget):
             point = point.toPoint()
         if len(self.images) == 0:
             return None
-        o = self._o
-        centerIndex = max(0, min(round(self._pos), len(self.images)-1))
-        imagesLeft = imagesRight = o['imagesPerSide']
-        if self._pos < round(self._pos):
-            imagesLeft += 1
-        elif self._pos > round(self._pos):
-            imagesRight += 1
+        if not self.renderer.dirty:
+            # Use the rects of the last frame, which is what the user sees
+            return self.renderer.hitTest(point)
+        start, centerIndex, stop = self.renderer.layout.visibleRange()
         # Check images in front first
-        for index in _centerRange(max(0, centerIndex-imagesLeft), centerIndex,
-                                  min(centerIndex+imagesRight+1, len(self.images))):
+        for index in _centerRange(start, centerIndex, stop):
             rect = self.renderer.getRenderInfo(index, translate=True).rect
             if rect.contains(point):
                 return index
@@ -408,7 +1442,7 @@ class ImageFlowWidget(QtWidgets.QWidget):
             return None
         
     def paintEvent(self, event):
-        self.renderer.paint()
+        self.renderer.paint(event.rect())
         
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Left:
@@ -456,8 +1490,13 @@ class ImageFlowWidget(QtWidgets.QWidget):
             mimeData.setText(image.path)
             mimeData.setUrls([QtCore.QUrl(image.path)])
             if image.state == STATE_READY:
-                mimeData.setImageData(image.image)
-                drag.setPixmap(QtGui.QPixmap.fromImage(image.image).scaled(50, 50, Qt.KeepAspectRatio))
+                try:
+                    fullImage = image.fullImage(self._o['rotate'])
+                except TemporaryLoadError as e:
+                    print(e)
+                else:
+                    mimeData.setImageData(fullImage)
+                    drag.setPixmap(QtGui.QPixmap.fromImage(fullImage).scaled(50, 50, Qt.KeepAspectRatio))
             drag.setMimeData(mimeData)
             drag.exec_()
             
@@ -480,12 +1519,192 @@ class RenderInfo:
         self.fullRect = fullRect
        
 
+class Layout:
+    """Computes the RenderInfo-instances of all visible images of a Renderer in one pass. The result is
+    memoized until the position, the size of the buffer, the options or the state of a visible image
+    change.
+    """
+    # Options which affect the layout
+    OPTIONS = ['curve', 'segmentRads', 'imagesPerSide', 'minScale', 'size', 'imageVAlign',
+               'reflection', 'reflectionFactor', 'paintReflection']
+    
+    def __init__(self, renderer):
+        self.renderer = renderer
+        self.widget = renderer.widget
+        self._o = renderer._o
+        self._key = None
+        self._infos = None
+        
+    def visibleRange(self):
+        """Return a tuple (start, center, stop): The images with indexes in range(start, stop) are visible,
+        *center* is the index of the central image. If there are no images, return (0, None, 0)."""
+        pos = self.widget._pos
+        count = len(self.widget.images)
+        if count == 0:
+            return 0, None, 0
+        centerIndex = max(0, min(round(pos), count-1))
+        imagesLeft = imagesRight = self._o['imagesPerSide']
+        if pos < round(pos):
+            imagesLeft += 1
+        elif pos > round(pos):
+            imagesRight += 1
+        return max(0, centerIndex-imagesLeft), centerIndex, min(centerIndex+imagesRight+1, count)
+    
+    def renderInfos(self):
+        """Return a list containing the RenderInfo-instances of all visible images (in the order of
+        visibleRange). The instances are shared and must not be modified."""
+        start, _, stop = self.visibleRange()
+        o = self._o
+        images = self.widget.images[start:stop]
+        key = (self.widget._pos, start, stop, self.renderer.buffer.width(), self.widget._generation,
+               tuple(o[option] for option in self.OPTIONS),
+               tuple((image, image.state, image._cacheOptions) for image in images))
+        if key != self._key:
+            self._infos = self._computeInfos(start, images)
+            self._key = key
+        return self._infos
+    
+    def renderInfo(self, index):
+        """Return the RenderInfo-instance for the image at the given index (which need not be visible)."""
+        start, _, stop = self.visibleRange()
+        if start <= index < stop:
+            return self.renderInfos()[index-start]
+        else: return self._computeInfos(index, [self.widget.images[index]])[0]
+        
+    def _computeInfos(self, start, images):
+        """Compute RenderInfo-instances for *images*, which are located at indexes start, start+1,..."""
+        o = self._o
+        pos = self.widget._pos
+        lxs, scales = self._curve(start, len(images))
+        availableWidth = self.renderer._availableWidth()
+        maxHeight = o['size'].height()
+        infos = []
+        for index, (image, lx, scale) in enumerate(zip(images, lxs, scales), start):
+            if index == pos: # central image; the if is necessary if o['imagesPerSide']=0
+                lx, scale = 0, 1
+            if scale <= 0:
+                rect = QtCore.QRect() # invalid rect
+                infos.append(RenderInfo(image, lx, rect, rect))
+                continue
+            w, h, fullH = self._imageSize(image)
+            w, h, fullH = scale * w, scale * h, scale * fullH
+            x = (lx * availableWidth) / 2 # Scale x from [-1, 1] to pixel coordinates
+            x -= w / 2 # lx refers to the center
+            # The correct vertical offset y satisfies y + imageVAlign*scaledHeight = imageVAlign*maxHeight
+            y = o['imageVAlign'] * (maxHeight - h)
+            rect = QtCore.QRect(int(x), int(y), int(w), int(h))
+            fullRect = QtCore.QRect(int(x), int(y), int(w), int(fullH)) if fullH != h else rect
+            infos.append(RenderInfo(image, lx, rect, fullRect))
+        return infos
+    
+    def _imageSize(self, image):
+        """Return width, height and height including the reflection of *image* at scale 1."""
+        o = self._o
+        if image.hasCache():
+            pixmap = image.cache(convert=False) # only the size is needed
+            cacheOptions = image._cacheOptions
+            w = pixmap.width()
+            fullH = pixmap.height()
+            if image.hasReflection():
+                h = fullH / (1+cacheOptions['reflectionFactor'])
+            else: h = fullH
+            if image.isOutdated(self.widget._generation):
+                # Until the cache has been rebuilt, display it using the current size
+                factor = min(o['size'].width() / w, o['size'].height() / h)
+                w, h, fullH = factor * w, factor * h, factor * fullH
+            if o['reflection'] and o['paintReflection'] and not image.hasReflection():
+                fullH = h * (1+o['reflectionFactor']) # reflection is drawn by Renderer.renderReflection
+            return w, h, fullH
+        else:
+            # placeholder/loading image will be drawn
+            return o['size'].width(), o['size'].height(), o['size'].height()
+        
+    def _curve(self, start, count):
+        """Return horizontal positions (on a scale from -1 to 1) and scale factors of *count* images
+        starting at index *start* as two lists."""
+        o = self._o
+        ips = o['imagesPerSide']
+        if ips == 0:
+            return [0] * count, [0] * count # only the central image is visible
+        minScale = o['minScale']
+        lxs = []
+        scales = []
+        for index in range(start, start+count):
+            lx, z = _curvePoint(o, (index - self.widget._pos) / ips)
+            lxs.append(lx)
+            scales.append(minScale + min(1, z) * (1.-minScale))
+        return lxs, scales
+    
+    
+def _curvePoint(o, d):
+    """Evaluate the curve specified by the options *o* for an image *d* * o['imagesPerSide'] positions
+    away from the center. Return the horizontal position lx in [-1, 1] and the "depth" z in [0, 1].
+    """
+    # When seen from above, the images are arranged on a curve, with the central image
+    # being "nearest" to the user and the outermost images being "farthest".
+    # This is then used to determine the scale factors in the front view.
+    # The curve is between [-1,1] for lx and [0,1] for z
+    if o['curve'] == "arc":
+        radians = d * o['segmentRads'] / 2
+        lx = math.sin(radians)/abs(math.sin(o['segmentRads']/2))
+        minCos = math.cos(o['segmentRads']/2)
+        z = (math.cos(radians)-minCos)/(1.-minCos) # between 0 and 1
+    elif o['curve'] == "v":
+        lx = d
+        z = 1.-abs(lx)
+    elif o['curve'] == "cos":
+        lx = d
+        z = math.cos(lx*math.pi/2.) # between 0 and 1
+    elif o['curve'] == "cossqrt":
+        lx = d
+        if lx >= 0:
+            lx = math.sqrt(lx)
+        else: lx = -math.sqrt(-lx)
+        z = math.cos(lx*math.pi/2.) # between 0 and 1
+    elif o['curve'] == "peak":
+        lx = d
+        if lx >= 0:
+            z = (lx-1)**2
+        else: z = (lx+1)**2
+    elif o['curve'] == "gallery":
+        lx = d
+        if abs(lx) >= 1./o['imagesPerSide']:
+            z = 0
+        elif lx >= 0:
+            z = (lx*o['imagesPerSide'] - 1)**2
+        else:
+            z = (lx*o['imagesPerSide'] + 1)**2
+    else:
+        assert False
+    return lx, z
+       
+
 class Renderer:
     """Renderer for ImageFlow. The renderer will render the images of the given ImageFlowWidget into
     an internal buffer and draw that buffer onto the widget."""
+    # Number of animation steps for which images are prefetched (see _prefetchRange)
+    PREFETCH_TICKS = 10
+    # Maximal time in ms per frame used to convert caches created by the worker into QPixmaps. Remaining
+    # conversions are done when the event loop is idle (see convertCaches).
+    CONVERSION_BUDGET = 4
+    
     def __init__(self, widget):
         self.widget = widget
         self._o = widget._o
+        self._requested = {} # images passed to the worker during the last rendering, mapped to their indexes
+        self._gradient = None # (key, brush) used by renderReflection
+        self.layout = Layout(self)
+        # List of tuples (rect, index) for all images rendered in the last frame, front to back. Rects use
+        # the ImageFlowWidget's coordinate system.
+        self.hitIndex = []
+        # Tuples (index, image, (state, cacheOptions), fullRect) for the images rendered in the last frame
+        self._drawn = []
+        self.damage = QtGui.QRegion() # parts that must be rendered again, see ImageFlowWidget.triggerRender
+        self._conversions = collections.OrderedDict() # images whose caches must be converted to QPixmaps
+        self._conversionTimer = QtCore.QTimer()
+        self._conversionTimer.setSingleShot(True)
+        self._conversionTimer.setInterval(0) # fires when all pending events have been processed
+        self._conversionTimer.timeout.connect(self.convertCaches)
         self.init()
         if widget.worker is not None:
             self._frame = 0
@@ -498,7 +1717,7 @@ class Renderer:
                 self._loadingAnim.loadFromData(pkgutil.get_data(__package__, 'process-working.png'))
             else: self._loadingAnim = QtGui.QPixmap(os.path.join(os.path.dirname(__file__), 'process-working.png'))
             self.widget.worker.loadingStarted.connect(self._timer.start, Qt.QueuedConnection)
-            self.widget.worker.loadingStopped.connect(self._timer.stop, Qt.QueuedConnection)
+            self.widget.worker.loadingStopped.connect(self._handleLoadingStopped, Qt.QueuedConnection)
     
     def init(self):
         """Initialize the internal buffer. Call this whenever the widget's size has changed."""
@@ -513,89 +1732,213 @@ class Renderer:
         self._frame += 1
         if self._frame >= 32:
             self._frame = 1 # skip 0, see process-working.png
-        self.widget.triggerRender()
+        self.widget.triggerRender(self._changedRegion(loading=True))
+        
+    def _handleLoadingStopped(self):
+        """Stop the timer when the worker is idle and render the images that have been loaded last."""
+        self._timer.stop()
+        self.widget.triggerRender(self._changedRegion(loading=False))
+        
+    def _changedRegion(self, loading):
+        """Return the region (in the ImageFlowWidget's coordinate system) of the images in the last frame
+        whose state has changed since. If *loading* is true, include the animations of loading images."""
+        region = QtGui.QRegion()
+        if self.dirty:
+            return region # everything will be rendered anyway
+        images = self.widget.images
+        for index, image, key, fullRect in self._drawn:
+            if (image.state, image._cacheOptions) != key:
+                region = region.united(fullRect)
+                if index < len(images) and images[index] is image:
+                    region = region.united(self.getRenderInfo(index, translate=True).fullRect)
+            elif loading and image.state == STATE_INIT:
+                region = region.united(self._loadingAnimRect(fullRect).adjusted(-1, -1, 1, 1))
+        return region
         
-    def paint(self):
-        """Render images if self.dirty is true. In any case copy the buffer to the ImageFlowWidget."""
+    def paint(self, rect=None):
+        """Render images if self.dirty is true or the parts in self.damage otherwise. In any case copy the
+        buffer (or only the given QRect of it) to the ImageFlowWidget."""
         if self.widget.size() != self.size:
             self.init()
         
+        metrics = self.widget.metrics
+        rendered = self.dirty or not self.damage.isEmpty()
+        if metrics is not None and rendered:
+            startTime = time.perf_counter()
         if self.dirty:
             self.render()
+        elif rendered:
+            self.renderImages(self.damage)
+            self.damage = QtGui.QRegion()
+        if metrics is not None:
+            if rendered:
+                metrics.record('paintTime', (time.perf_counter() - startTime) * 1000)
+            # Count cache hits in every painted frame, no matter whether and how much has been rendered
+            start, _, stop = self.layout.visibleRange()
+            images = self.widget.images
+            hits = sum(1 for index in range(start, stop) if images[index].state == STATE_READY)
+            metrics.count('cacheHits', hits)
+            metrics.count('cacheMisses', stop - start - hits)
+            metrics.setValue('cacheMemory', self.widget.cacheManager.size())
         
         painter = QtGui.QPainter(self.widget)
-        painter.drawPixmap(0, 0, self.buffer)
+        if rect is None:
+            painter.drawPixmap(0, 0, self.buffer)
+        else: painter.drawPixmap(rect, self.buffer, rect)
+        painter.end()
+        self.convertCaches()
+        
+    def convertCaches(self):
+        """Convert caches created by the worker thread into QPixmaps (see Image.convert) until
+        CONVERSION_BUDGET ms have elapsed. If images remain, continue when the event loop is idle. Until
+        their conversion, images are drawn directly from QImages, so that painting never has to wait for
+        conversions."""
+        deadline = time.perf_counter() + self.CONVERSION_BUDGET / 1000
+        while len(self._conversions) > 0 and time.perf_counter() < deadline:
+            image, _ = self._conversions.popitem(last=False)
+            image.convert()
+        if len(self._conversions) > 0:
+            self._conversionTimer.start()
   
     def render(self):
         """Render background and all images."""
         self.buffer.fill(self._o['background'])
+        self.hitIndex = []
+        self._drawn = []
         self.renderImages()
         self.dirty = False
+        self.damage = QtGui.QRegion()
+        
+    def hitTest(self, point):
+        """Return the index of the image at *point* (QPoint in the ImageFlowWidget's coordinate system) in
+        the last rendered frame, or None if no image has been rendered there."""
+        for rect, index in self.hitIndex:
+            if rect.contains(point):
+                return index
+        return None
     
-    def renderImages(self):
-        """Render all images."""
+    def renderImages(self, region=None):
+        """Render all images. If *region* (a QRegion in the ImageFlowWidget's coordinate system) is given,
+        only render the parts of images within this region (after filling it with the background)."""
         o = self._o
         images = self.widget.images
         if len(images) == 0:
             return
         painter = QtGui.QPainter(self.buffer)
+        if region is not None:
+            painter.setClipRegion(region)
+            painter.fillRect(region.boundingRect(), o['background'])
         painter.setRenderHint(QtGui.QPainter.Antialiasing)
         # Using smooth transforms needs twice as much time (which is too little to notice). Because I can't
         # see any difference in image quality I don't use it.
         # Note that it makes no difference for the central image which is copied from cache without resizing.
-        painter.translate(*self._getTranslation())
-        centerIndex = max(0, min(round(self.widget._pos), len(images)-1))
-        imagesLeft = imagesRight = o['imagesPerSide']
-        if self.widget._pos < round(self.widget._pos):
-            imagesLeft += 1
-        elif self.widget._pos > round(self.widget._pos):
-            imagesRight += 1
-        imagesLeft = range(max(0, centerIndex-imagesLeft), centerIndex)
-        imagesRight = range(centerIndex+1, min(centerIndex+imagesRight+1, len(self.widget.images)))
+        dx, dy = self._getTranslation()
+        painter.translate(dx, dy)
+        start, centerIndex, stop = self.layout.visibleRange()
+        imagesLeft = range(start, centerIndex)
+        imagesRight = range(centerIndex+1, stop)
              
-        if DEBUG_TIMES:
-            if all(images[i]._cache is not None for i in
-                range(max(0, centerIndex-imagesLeft),
-                      min(len(images), centerIndex+imagesRight+1))):
-                start = time.perf_counter()
-            else: start = None
-           
         # Load necessary images from center to the sides
-        loadList = [images[index] for index in _centerRange(imagesLeft.start, centerIndex, imagesRight.stop)
-                    if images[index].state == STATE_INIT]
+        prefetch = self._prefetchRange(imagesLeft.start, imagesRight.stop)
+        generation = self.widget._generation
+        loadIndexes = [index for index in itertools.chain(
+                                _centerRange(imagesLeft.start, centerIndex, imagesRight.stop), prefetch)
+                       if images[index].needsCache(generation)]
+        loadList = [images[index] for index in loadIndexes]
+        # Images requested before may have been loaded although they are not visible anymore.
+        for image, index in self._requested.items():
+            if image.state == STATE_READY:
+                self.widget.cacheManager.touch(image, index)
+            if image.needsConversion():
+                self._conversions[image] = None
+        self._requested = dict(zip(loadList, loadIndexes))
         if self.widget.worker is not None:
             self.widget.worker.load(loadList)
-        else:
+        elif len(loadList) > 0:
+            options = o.copy()
             for image in loadList:
-                image.createCache(o)
-            
-        # Render left images from left to center
-        centerInfo = self.getRenderInfo(centerIndex)
-        nextInfo = None
-        for i in imagesLeft:
-            info = nextInfo if nextInfo is not None else self.getRenderInfo(i)
-            nextInfo = self.getRenderInfo(i+1) if i+1 in imagesLeft else centerInfo
-            if info.image.state == STATE_READY and nextInfo.image.state == STATE_READY:
-                self.renderImage(painter, info, nextRect=nextInfo.fullRect, left=True)
-            else: self.renderImage(painter, info)
-            
-        # Render right images from right to center
-        nextInfo = None
-        for i in reversed(imagesRight):
-            info = nextInfo if nextInfo is not None else self.getRenderInfo(i)
-            nextInfo = self.getRenderInfo(i-1) if i-1 in imagesRight else centerInfo
-            if info.image.state == STATE_READY and nextInfo.image.state == STATE_READY:
-                self.renderImage(painter, info, nextRect=nextInfo.fullRect, left=False)
-            else: self.renderImage(painter, info)
+                try:
+                    image.createCache(options, self.widget.diskCache, generation, self.widget.metrics)
+                except TemporaryLoadError as e:
+                    print(e) # the image remains in STATE_INIT and is loaded again in the next render
             
-        # Render center image
-        self.renderImage(painter, centerInfo)#, text=images[centerIndex].path[-30:])
+        infos = self.layout.renderInfos()
+        centerInfo = infos[centerIndex-start]
+        if region is None:
+            # Render left images from left to center
+            for i in imagesLeft:
+                info = infos[i-start]
+                nextInfo = infos[i+1-start]
+                if info.image.hasCache() and nextInfo.image.hasCache():
+                    self.renderImage(painter, info, nextRect=nextInfo.fullRect, left=True)
+                else: self.renderImage(painter, info)
+                
+            # Render right images from right to center
+            for i in reversed(imagesRight):
+                info = infos[i-start]
+                nextInfo = infos[i-1-start]
+                if info.image.hasCache() and nextInfo.image.hasCache():
+                    self.renderImage(painter, info, nextRect=nextInfo.fullRect, left=False)
+                else: self.renderImage(painter, info)
+                
+            # Render center image
+            self.renderImage(painter, centerInfo)#, text=images[centerIndex].path[-30:])
+        else:
+            # Same order as above, but skip images outside of region. Because the images in front are
+            # possibly not rendered completely, the parts hidden by them (nextRect) must be rendered, too.
+            for i in itertools.chain(imagesLeft, reversed(imagesRight), [centerIndex]):
+                info = infos[i-start]
+                if region.intersects(info.fullRect.translated(dx, dy)):
+                    self.renderImage(painter, info)
 
         painter.end()
-        if DEBUG_TIMES and start is not None:
-            _times.append(time.perf_counter() - start)
-            print(sum(_times) / len(_times))
+        
+        # Store the rects in z-order (front first) for hitTest and remember what has been drawn
+        self.hitIndex = [(infos[i-start].rect.translated(dx, dy), i)
+                         for i in _centerRange(start, centerIndex, stop) if infos[i-start].rect.isValid()]
+        self._drawn = [(i, infos[i-start].image, (infos[i-start].image.state, infos[i-start].image._cacheOptions),
+                        infos[i-start].fullRect.translated(dx, dy))
+                       for i in range(start, stop) if infos[i-start].fullRect.isValid()]
+        
+        # Remove images far away from the center if they use too much memory
+        visible = range(imagesLeft.start, imagesRight.stop)
+        cacheManager = self.widget.cacheManager
+        for index in visible:
+            if images[index].state == STATE_READY:
+                cacheManager.touch(images[index], index)
+            if images[index].needsConversion():
+                self._conversions[images[index]] = None
+        if len(prefetch) > 0:
+            keep = range(min(visible.start, min(prefetch)), max(visible.stop, max(prefetch)+1))
+        else: keep = visible
+        if cacheManager.maxSize > 0 and cacheManager.size() > cacheManager.maxSize \
+                and self.widget.worker is not None:
+            busy = self.widget.worker.busyImages()
+        else: busy = ()
+        cacheManager.shrink(self.widget._pos, keep, busy)
+        if isinstance(images, ImageList):
+            for image in images.release(keep):
+                cacheManager.remove(image)
        
+    def _prefetchRange(self, start, stop):
+        """Return the range of indexes of images that should be loaded in advance, because they will soon
+        become visible. *start* and *stop* define the range of currently visible images. Images are only
+        prefetched in the direction of the animation. The range contains all images that will be visible
+        at the animation's target and the images that will become visible within the next PREFETCH_TICKS
+        animation steps at the current velocity, but not more than o['prefetch'] images.
+        """
+        depth = self._o['prefetch']
+        target = self.widget.animator.target()
+        if self.widget.worker is None or depth <= 0 or target == self.widget._pos:
+            return range(0)
+        count = math.ceil(abs(self.widget.animator.velocity()) * self.PREFETCH_TICKS)
+        if target > self.widget._pos:
+            count = max(count, math.ceil(target) + self._o['imagesPerSide'] + 1 - stop)
+            return range(stop, min(stop + min(count, depth), len(self.widget.images)))
+        else:
+            count = max(count, start - (math.floor(target) - self._o['imagesPerSide']))
+            return range(max(0, start - min(count, depth)), start)[::-1]
+        
     def renderImage(self, painter, info, text=None, nextRect=None, left=None):
         """Render a single image using *painter*. *info* is the RenderInfo-instance for the image,
         *text* is a text that should be rendered below, *nextRect* is the rect of the next image to the 
@@ -610,8 +1953,11 @@ class Renderer:
         elif info.image.state == STATE_FAILED:
             self.renderMissingImage(painter, info.rect)
         else:
-            pixmap = info.image.cache()
-            rect = info.fullRect
+            rect = QtCore.QRect(info.fullRect) # RenderInfo-instances are shared, see Layout
+            # Caches that have not been converted yet are drawn as QImages (see convertCaches)
+            if self._o['mipmaps']:
+                pixmap = info.image.cacheLevel(rect.width(), convert=False)
+            else: pixmap = info.image.cache(convert=False)
             
             source = None
             if nextRect is not None and nextRect.isValid():
@@ -620,19 +1966,19 @@ class Renderer:
                     if nextRect.top() <= rect.top() and nextRect.bottom() >= rect.bottom() \
                             and nextRect.right() >= rect.right():
                         part = (nextRect.left()-rect.left()) / rect.width()
-                        source = QtCore.QRect(0, 0, part * pixmap.width(), pixmap.height())
+                        source = QtCore.QRect(0, 0, round(part * pixmap.width()), pixmap.height())
                         rect.setRight(nextRect.left())
                 else:
                     if nextRect.top() <= rect.top() and nextRect.bottom() >= rect.bottom() \
                             and nextRect.left() <= rect.left():
                         part = (rect.right()-nextRect.right()) / rect.width()
-                        source = QtCore.QRect((1-part)*pixmap.width(), 0,
-                                              part*pixmap.width(), pixmap.height())
+                        source = QtCore.QRect(round((1-part)*pixmap.width()), 0,
+                                              round(part*pixmap.width()), pixmap.height())
                         rect.setLeft(nextRect.right())
             
-            if source is None:
-                painter.drawPixmap(rect, pixmap)
-            else: painter.drawPixmap(rect, pixmap, source)
+            if rect.height() > info.rect.height() and not info.image.hasReflection():
+                self.renderReflection(painter, info, pixmap, rect, source)
+            else: _drawCache(painter, rect, pixmap, source)
         
         if text is not None:
             textRect = QtCore.QRect(info.rect.left(), info.rect.bottom(), info.rect.width(), 30)
@@ -646,88 +1992,58 @@ class Renderer:
                 if alpha < 255:
                     color = QtGui.QColor(self._o['background'])
                     color.setAlpha(255-alpha)
-                    painter.fillRect(info.fullRect, color)
+                    # Only the visible part of the image needs to be faded out
+                    painter.fillRect(rect if info.image.hasCache() else info.fullRect, color)
         
-    def getRenderInfo(self, index, translate=False):
-        """Get a RenderInfo-instance for the image at the given index. If *translate* is true, use the
-        ImageFlowWidget's coordinate system, otherwise use the drawing coordinate system.
+    def renderReflection(self, painter, info, pixmap, rect, source):
+        """Render an image whose cache does not contain the reflection (option 'paintReflection') together
+        with its reflection. *pixmap* is the image's cache, *rect* is the part of info.fullRect that must be
+        drawn and *source* the corresponding part of *pixmap* (or None if the whole image must be drawn).
         """
         o = self._o
-        image = self.widget.images[index]
+        imageRect = QtCore.QRect(rect.left(), rect.top(), rect.width(), info.rect.height())
+        reflectionRect = QtCore.QRect(rect.left(), imageRect.bottom()+1,
+                                      rect.width(), rect.height()-imageRect.height())
+        _drawCache(painter, imageRect, pixmap, source)
+        if o['reflectionAlpha'] <= 0:
+            return
         
-        if index == self.widget.position(): # central image; the if is necessary if o['imagesPerSide']=0
-            lx = 0
-            z = 1
+        # The reflection (the lower part of the image, upside down) is cached for each image
+        factor = o['reflectionFactor']
+        cached = info.image._reflection
+        if cached is not None and cached[0]() is pixmap and cached[1] == factor:
+            reflection = cached[2]
         else:
-            # When seen from above, the images are arranged on a curve, with the central image
-            # being "nearest" to the user and the outermost images being "farthest".
-            # This is then used to determine the scale factors in the front view.
-            # The curve is between [-1,1] for lx and [0,1] for z
-            if o['curve'] == "arc":
-                radians = (index-self.widget._pos) / o['imagesPerSide'] * o['segmentRads'] / 2
-                lx = math.sin(radians)/abs(math.sin(o['segmentRads']/2))
-                minCos = math.cos(o['segmentRads']/2)
-                z = (math.cos(radians)-minCos)/(1.-minCos) # between 0 and 1
-            elif o['curve'] == "v":
-                lx = (index-self.widget._pos) / o['imagesPerSide']
-                z = 1.-abs(lx)
-            elif o['curve'] == "cos":
-                lx = (index-self.widget._pos) / o['imagesPerSide']
-                z = math.cos(lx*math.pi/2.) # between 0 and 1
-            elif o['curve'] == "cossqrt":
-                lx = (index-self.widget._pos) / o['imagesPerSide']
-                if lx >= 0:
-                    lx = math.sqrt(lx)
-                else: lx = -math.sqrt(-lx)
-                z = math.cos(lx*math.pi/2.) # between 0 and 1
-            elif o['curve'] == "peak":
-                lx = (index-self.widget._pos) / o['imagesPerSide']
-                if lx >= 0:
-                    z = (lx-1)**2
-                else: z = (lx+1)**2
-            elif o['curve'] == "gallery":
-                lx = (index-self.widget._pos) / o['imagesPerSide']
-                if abs(lx) >= 1./o['imagesPerSide']:
-                    z = 0
-                elif lx >= 0:
-                    z = (lx*o['imagesPerSide'] - 1)**2
-                else:
-                    z = (lx*o['imagesPerSide'] + 1)**2
-            else:
-                assert False
-         
-        scale = o['minScale'] + min(1, z) * (1.-o['minScale'])
-        if scale <= 0:
-            rect = QtCore.QRect() # invalid rect
-            return RenderInfo(image, lx, rect, rect)
-             
-        if image.state == STATE_READY:
-            pixmap = image.cache()
-            w = scale * pixmap.width()
-            if o['reflection']:
-                fullH = scale * pixmap.height()
-                h = fullH / (1+o['reflectionFactor'])
-            else:
-                h = fullH = scale * pixmap.height()
-        else:
-            # placeholder/loading image will be drawn
-            w = scale * o['size'].width()
-            h = fullH = scale * o['size'].height()
-         
-        x = (lx * self._availableWidth()) / 2 # Scale x from [-1, 1] to pixel coordinates
-        x -= w / 2 # lx refers to the center
-        # The correct vertical offset y satisfies y + imageVAlign*scaledHeight = imageVAlign*maxHeight
-        y = o['imageVAlign'] * (o['size'].height() - h)
-
-        rect = QtCore.QRect(x, y, w, h)
-        fullRect = QtCore.QRect(x, y, w, fullH) if fullH != h else rect
+            h = max(1, min(int(pixmap.height() * factor), pixmap.height()))
+            reflection = pixmap.copy(0, pixmap.height()-h, pixmap.width(), h) \
+                               .transformed(QtGui.QTransform(1, 0, 0, -1, 0, 0))
+            info.image._reflection = (weakref.ref(pixmap), factor, reflection)
+        _drawCache(painter, reflectionRect, reflection,
+                   QtCore.QRect(source.x(), 0, source.width(), reflection.height()) if source is not None else None)
         
-        if translate:
-            rect.translate(*self._getTranslation())
-            if fullRect is not rect:
-                fullRect.translate(*self._getTranslation())
-          
-        return RenderInfo(image, lx, rect, fullRect)
+        # All reflections share one gradient
+        key = (QtGui.QColor(o['background']).rgba(), o['reflectionAlpha'])
+        if self._gradient is None or self._gradient[0] != key:
+            gradient = QtGui.QLinearGradient(0, 0, 0, 1)
+            gradient.setCoordinateMode(QtGui.QGradient.ObjectBoundingMode)
+            color = QtGui.QColor(o['background'])
+            color.setAlpha(round((1.-o['reflectionAlpha'])*255))
+            gradient.setColorAt(0, color)
+            gradient.setColorAt(1, o['background'])
+            self._gradient = (key, QtGui.QBrush(gradient))
+        painter.fillRect(reflectionRect, self._gradient[1])
+        
+    def getRenderInfo(self, index, translate=False):
+        """Get a RenderInfo-instance for the image at the given index. If *translate* is true, use the
+        ImageFlowWidget's coordinate system, otherwise use the drawing coordinate system.
+        """
+        info = self.layout.renderInfo(index)
+        if translate and info.rect.isValid():
+            dx, dy = self._getTranslation()
+            rect = info.rect.translated(dx, dy)
+            fullRect = info.fullRect.translated(dx, dy) if info.fullRect is not info.rect else rect
+            info = RenderInfo(info.image, info.logicalX, rect, fullRect)
+        return info
           
     def renderMissingImage(self, painter, rect):
         """Render a crossed rectangle into *rect* to indicate an image that could not be loaded."""
@@ -753,9 +2069,14 @@ class Renderer:
         x = 32 * (self._frame % 8)
         y = 32 * (self._frame // 8)
         source = QtCore.QRect(x, y, 32, 32)
-        target = QtCore.QRect(source)
+        painter.drawPixmap(self._loadingAnimRect(rect), self._loadingAnim, source)
+        
+    def _loadingAnimRect(self, rect):
+        """Return the rect used by renderLoadingImage to draw the loading animation for an image in *rect*.
+        """
+        target = QtCore.QRect(0, 0, 32, 32)
         target.moveCenter(rect.center())
-        painter.drawPixmap(target, self._loadingAnim, source)
+        return target
         
     def _availableWidth(self):
         """Return the width of the region that can be used for the center of images. This is a bit less than
@@ -775,7 +2096,12 @@ class Renderer:
 
 
 class Animator:
-    """This class moves images during animation."""
+    """This class moves images during animation. By default the timer fires every INTERVAL ms and images
+    move a fixed distance each time. If the option 'timeBasedAnimation' is set, the timer fires with the
+    option 'frameRate' (or the screen's refresh rate) and images move according to the elapsed time, so
+    that frames are skipped if painting is too slow. Statistics about late and dropped frames are
+    available via stats.
+    """
     INTERVAL = 30
     
     def __init__(self, widget):
@@ -785,8 +2111,10 @@ class Animator:
         self.timer.timeout.connect(self.update)
         self._target = None
         self._start = None
-        self._a = 4. / self.INTERVAL  # acceleration
-        self._v = 0.                  # velocity
+        self._a = 4. / self.INTERVAL  # acceleration (per INTERVAL)
+        self._v = 0.                  # velocity (per INTERVAL)
+        self._lastTime = None         # time of the last step (time.perf_counter is monotonic)
+        self.resetStats()
         
     def target(self):
         """Return the current target index."""
@@ -794,6 +2122,39 @@ class Animator:
             return self._target
         else: return self.widget._pos
        
+    def velocity(self):
+        """Return the current velocity in positions per animation step. The velocity is negative when images
+        move to the left (i.e. the position decreases) and 0 if no animation is running."""
+        if not self.timer.isActive() or self._target is None or self._target == self.widget._pos:
+            return 0.
+        return self._v if self._target > self.widget._pos else -self._v
+    
+    def stats(self):
+        """Return a dict with statistics about all animation steps since the last call of resetStats:
+            - frames: number of steps,
+            - lateFrames: number of steps that came more than half an interval too late,
+            - droppedFrames: number of frames that were skipped, because a step came too late or the
+              previous frame has not been painted yet (only in time based mode).
+        """
+        return {'frames': self._frames, 'lateFrames': self._lateFrames, 'droppedFrames': self._droppedFrames}
+    
+    def resetStats(self):
+        """Reset the statistics returned by stats."""
+        self._frames = self._lateFrames = self._droppedFrames = 0
+        
+    def _interval(self):
+        """Return the timer interval in ms according to the current options."""
+        o = self.widget._o
+        if not o['timeBasedAnimation']:
+            return self.INTERVAL
+        frameRate = o['frameRate']
+        if frameRate <= 0:
+            try:
+                frameRate = QtGui.QGuiApplication.primaryScreen().refreshRate()
+            except AttributeError: # Qt 4
+                frameRate = 60
+        return max(1, round(1000 / frameRate))
+        
     def start(self, target):
         """Start animation moving to the given target index."""
         target = max(0, min(target, len(self.widget.images)-1))
@@ -801,6 +2162,11 @@ class Animator:
                 or (self._target - self.widget._pos) * (target - self.widget._pos) < 0: # different direction
             self._target = target
             self._v = 0.
+            self._lastTime = time.perf_counter()
+            if hasattr(self.timer, 'setTimerType'): # Qt >= 5.0
+                self.timer.setTimerType(Qt.PreciseTimer if self.widget._o['timeBasedAnimation']
+                                        else Qt.CoarseTimer)
+            self.timer.setInterval(self._interval())
             self.timer.start()
         else:
             self._target = target
@@ -817,11 +2183,25 @@ class Animator:
             self.stop()
             self.widget.indexChanged.emit(t)
             return
+        now = time.perf_counter()
+        elapsed = (now - self._lastTime) * 1000
+        self._lastTime = now
+        interval = self.timer.interval()
+        self._frames += 1
+        if elapsed > 1.5 * interval:
+            self._lateFrames += 1
+        if self.widget._o['timeBasedAnimation']:
+            # Move as far as the elapsed time requires. This skips frames if the timer comes too late.
+            steps = elapsed / self.INTERVAL
+            self._droppedFrames += max(0, round(elapsed / interval) - 1)
+            if self.widget.renderer.dirty:
+                self._droppedFrames += 1 # the previous frame has not been painted
+        else: steps = 1
         dist = abs(t - self.widget._pos)
-        self._v = min(self._v + self._a, math.sqrt(2*self._a*dist))
+        self._v = min(self._v + self._a * steps, math.sqrt(2*self._a*dist))
         if t > self.widget._pos:
-            self.widget._pos = min(t, self.widget._pos + self._v)
-        else: self.widget._pos = max(t, self.widget._pos - self._v)
+            self.widget._pos = min(t, self.widget._pos + self._v * steps)
+        else: self.widget._pos = max(t, self.widget._pos - self._v * steps)
         self.widget.triggerRender()
 
 
@@ -830,30 +2210,103 @@ class Worker(QtCore.QThread):
     that it will load. Contrary to the usual queues, 'load' does not add images to the list but replaces
     the whole list. The attribute 'timer' stores a QTimer that signals regularly while images are loaded.
     Use this to draw animations.
+    Depending on the option 'threads', the worker starts additional threads. All threads take images from
+    the same list, so that images are still loaded in the order of the list.
     """
     loadingStarted = QtCore.pyqtSignal()
     loadingStopped = QtCore.pyqtSignal()
+    # Seconds after which images whose loader raised TemporaryLoadError are loaded again
+    RETRY_DELAY = 5
     
     def __init__(self, options, parent):
         super().__init__(parent)
         self.options = options
+        self.diskCache = None
+        self.metrics = None
+        self._generation = 0
         self._running = True
         self._loading = False
-        self._newEvent = threading.Event() # wakes up the worker thread if something happens
-        self._emptyEvent = None # is used to wait on the worker thread to finish
+        # Protects the following attributes and wakes up threads if something happens
+        self._condition = threading.Condition()
         self._loadList = []
+        self._busy = set()    # images that are currently loaded by some thread
+        self._previewed = set() # images in the load list for which a preview has been tried
+        self._retryTimes = {} # maps images in the load list that failed temporarily to the time of the retry
+        self._loaders = set() # loaders of the images in the load list (only used by the GUI thread)
+        self._threads = {}    # maps indexes to the additional threads (the QThread itself has index 0)
     
     def load(self, images):
-        """Load the given list of images. Call this whenever the list of necessary images changes."""
-        self._loadList = images
-        self._newEvent.set()
+        """Load the given list of images. Call this whenever the list of necessary images changes.
+        Images that are not contained in the new list will not be loaded anymore (unless they are already
+        being loaded). The loaders of the images are informed about the new list (see Loader.request)."""
+        with self._condition:
+            self._loadList = images
+            self._previewed.intersection_update(images)
+            # Images that leave the load list are retried immediately when they are requested again
+            loadSet = set(images)
+            self._retryTimes = {image: t for image, t in self._retryTimes.items() if image in loadSet}
+            self._condition.notify_all()
+        if self.metrics is not None:
+            self.metrics.record('queueDepth', len(images))
+        
+        # Let loaders fetch images in advance (unless they are contained in the disk cache) and cancel
+        # images that are not needed anymore
+        loaderImages = collections.defaultdict(list)
+        diskCache, options = self.diskCache, self.options
+        for image in images:
+            if image.loader is not None:
+                if diskCache is not None:
+                    key = image.loader.cacheKey(image)
+                    if key is not None and diskCache.contains(image.path, options, key):
+                        continue
+                loaderImages[image.loader].append(image)
+        for loader in self._loaders:
+            if loader not in loaderImages:
+                loader.request([])
+        self._loaders = set(loaderImages)
+        for loader, images in loaderImages.items():
+            loader.request(images)
           
+    def setOptions(self, options, generation):
+        """Set the options used to create caches. *options* must not be modified afterwards, so pass a
+        copy. Images whose cache has been created for a different *generation* (see Image.createCache)
+        are loaded again when they are contained in the load list. This method does not block."""
+        with self._condition:
+            self.options = options
+            self._generation = generation
+            self._condition.notify_all()
+            
     def reset(self):
         """Clear the list of images and block until the worker thread is idle."""
-        self._emptyEvent = threading.Event()
-        self.load([])
-        self._emptyEvent.wait()
-        self._emptyEvent = None
+        with self._condition:
+            self._loadList = []
+            while len(self._busy) > 0:
+                self._condition.wait()
+    
+    def busyImages(self):
+        """Return the set of images which are currently loaded by one of the threads."""
+        with self._condition:
+            return set(self._busy)
+        
+    def threadCount(self):
+        """Return the number of threads which should be used according to the option 'threads'."""
+        count = self.options['threads']
+        if count <= 0:
+            count = QtCore.QThread.idealThreadCount()
+        return max(1, count)
+    
+    def updateThreads(self):
+        """Start additional threads if the option 'threads' has been increased. Superfluous threads will
+        stop automatically."""
+        with self._condition:
+            if not self._running:
+                return
+            for index in range(1, self.threadCount()):
+                if index not in self._threads:
+                    thread = threading.Thread(target=self._work, args=(index,), daemon=True)
+                    self._threads[index] = thread
+                    thread.start()
+            self._condition.notify_all()
         
     def _setLoading(self, loading):
         if loading != self._loading:
@@ -864,25 +2317,141 @@ class Worker(QtCore.QThread):
                 
     def shutdown(self):
         """Stop the worker thread."""
-        self._setLoading(False)
-        self._running = False
-        self._newEvent.set()
+        with self._condition:
+            self._setLoading(False)
+            self._running = False
+            self._condition.notify_all()
         
     def run(self):
-        while self._running:
-            loadList = self._loadList
-            if len(loadList) == 0:
-                self._setLoading(False)
-                if self._emptyEvent is not None:
-                    self._emptyEvent.set()
-                self._newEvent.wait()
-                self._newEvent.clear()
-            else:
+        self.updateThreads()
+        self._work(0)
+        
+    def _nextImage(self):
+        """Return a tuple (image, preview): the first image in the load list that has to be loaded and is
+        not loaded by another thread, and whether only a preview should be created (option 'previews').
+        Previews of all images are created before the first full cache (_work skips previews of images whose
+        cache is stored in the disk cache). Images that failed temporarily are skipped until their retry time.
+        Return (None, False) if there is no such image. The caller must hold self._condition."""
+        if len(self._retryTimes) > 0:
+            now = time.perf_counter()
+            self._retryTimes = {image: t for image, t in self._retryTimes.items() if t > now}
+        if self.options['previews']:
+            for image in self._loadList:
+                if image.state == STATE_INIT and image not in self._busy and image not in self._previewed:
+                    return image, True
+        for image in self._loadList:
+            if image.needsCache(self._generation) and image not in self._busy \
+                    and image not in self._retryTimes:
+                return image, False
+        return None, False
+    
+    def _work(self, index):
+        """Main loop of the thread with the given index."""
+        while True:
+            with self._condition:
+                while True:
+                    if not self._running or index >= self.threadCount():
+                        self._threads.pop(index, None)
+                        return
+                    image, preview = self._nextImage()
+                    if image is not None:
+                        break
+                    if len(self._busy) == 0:
+                        self._setLoading(False)
+                    if len(self._retryTimes) > 0:
+                        self._condition.wait(max(0, min(self._retryTimes.values()) - time.perf_counter()))
+                    else: self._condition.wait()
+                self._busy.add(image)
                 self._setLoading(True)
-                for image in loadList:
-                    if image.state == STATE_INIT:
-                        image.createCache(self.options)
-                    break # check for a new list
+                options, generation = self.options, self._generation
+            retryTime = None
+            try:
+                if preview:
+                    # Reading a cache from the disk cache is faster than a preview and avoids a low-res flash.
+                    # Check this without holding the lock, because it accesses the file system.
+                    if self.diskCache is None or image.loader is not None or image.path is None \
+                            or not self.diskCache.contains(image.path, options):
+                        image.createPreview(options, generation)
+                else: image.createCache(options, self.diskCache, generation, self.metrics)
+            except LoadCancelled:
+                pass # the image remains in its state and is loaded when it is requested again
+            except TemporaryLoadError as e:
+                print(e)
+                retryTime = time.perf_counter() + self.RETRY_DELAY
+            finally:
+                with self._condition:
+                    if preview:
+                        self._previewed.add(image)
+                    if retryTime is not None:
+                        self._retryTimes[image] = retryTime
+                    self._busy.discard(image)
+                    self._condition.notify_all()
+        
+        
+class DirectoryScanner(QtCore.QThread):
+    """Thread that searches *folder* (optionally including subfolders) for images with one of the given
+    *extensions* and emits their paths in batches via the signal pathsFound, e.g. to pass them to
+    ImageFlowWidget.appendPaths. The first batch is emitted as soon as FIRST_BATCH images have been found,
+    later batches every INTERVAL ms, so that the first images can be displayed while the scan continues.
+    """
+    pathsFound = QtCore.pyqtSignal(list)
+    EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp')
+    FIRST_BATCH = 20
+    INTERVAL = 200
+    
+    def __init__(self, folder, recursive=False, extensions=EXTENSIONS, parent=None):
+        super().__init__(parent)
+        self.folder = folder
+        self.recursive = recursive
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        self._running = True
+        
+    def stop(self):
+        """Stop scanning as soon as possible. Paths that have not been emitted yet are discarded."""
+        self._running = False
+        
+    def run(self):
+        batch = []
+        first = True
+        lastTime = time.perf_counter()
+        folders = [self.folder]
+        while len(folders) > 0 and self._running:
+            try:
+                iterator = os.scandir(folders.pop())
+            except OSError:
+                continue # e.g. missing permissions
+            with iterator:
+                for entry in iterator:
+                    if not self._running:
+                        return
+                    try:
+                        if self.recursive and entry.is_dir(follow_symlinks=False):
+                            folders.append(entry.path)
+                        elif os.path.splitext(entry.name)[1].lower() in self.extensions and entry.is_file():
+                            batch.append(entry.path)
+                    except OSError:
+                        continue
+                    if len(batch) > 0 and (len(batch) >= self.FIRST_BATCH if first
+                                           else (time.perf_counter() - lastTime) * 1000 >= self.INTERVAL):
+                        self.pathsFound.emit(batch)
+                        batch = []
+                        first = False
+                        lastTime = time.perf_counter()
+        if len(batch) > 0 and self._running:
+            self.pathsFound.emit(batch)
+    
+    
+def _drawCache(painter, target, cache, source=None):
+    """Draw *cache* (a QPixmap or a QImage, see Image.cache) into the QRect *target* using *painter*. If
+    *source* is given, only draw this QRect of *cache*."""
+    if isinstance(cache, QtGui.QPixmap):
+        if source is None:
+            painter.drawPixmap(target, cache)
+        else: painter.drawPixmap(target, cache, source)
+    else:
+        if source is None:
+            painter.drawImage(target, cache)
+        else: painter.drawImage(target, cache, source)
         
         
 def _centerRange(start, center, stop):
@@ -973,10 +2542,13 @@ if __name__ == "__main__":
     import os, os.path, argparse, sys
     
     # Parse arguments
-    parser = argparse.ArgumentParser(description="Show the images within one folder in an ImageFlow.")
-    parser.add_argument('path', nargs='?', help="Path of the folder, defaults to current directory", default='.')
+    parser = argparse.ArgumentParser(description="Show the images within one folder or ZIP/CBZ archive "
+                                                 "in an ImageFlow.")
+    parser.add_argument('path', nargs='?', help="Path of the folder or archive, defaults to current directory",
+                        default='.')
     parser.add_argument('--random', help="Shuffle the images.", action='store_true')
     parser.add_argument('--no-random', dest='random', action='store_false')
+    parser.add_argument('--recursive', help="Include images in subfolders.", action='store_true')
     defaults={'random': False}
     for option, (optionType, default, description) in OPTIONS.items():
         if optionType is bool:
@@ -990,13 +2562,21 @@ if __name__ == "__main__":
     parser.set_defaults(**defaults)
     args = parser.parse_args()
     
-    # Load paths
     folder = os.path.abspath(os.path.expanduser(args.path))
-    paths = [os.path.join(folder, filename) for filename in os.listdir(folder)]
-    paths = [path for path in paths if os.path.splitext(path)[1].lower() in ['.png', '.jpg', '.jpeg', '.bmp']]
-    if args.random:
-        import random
-        random.shuffle(paths)
+    archive = None
+    if os.path.isfile(folder) and os.path.splitext(folder)[1].lower() in ('.zip', '.cbz'):
+        import zipfile
+        # When this file is run as a script, the package must be importable to use its submodules
+        sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        from imageflow.loaders import ArchiveLoader
+        try:
+            archive = ArchiveLoader(folder)
+        except (OSError, zipfile.BadZipFile) as e:
+            print("Cannot open archive '{}': {}".format(folder, e))
+            sys.exit(1)
+    elif not os.path.isdir(folder):
+        print("'{}' is neither a folder nor a ZIP/CBZ archive.".format(folder))
+        sys.exit(1)
        
     # Create GUI
     app = QtWidgets.QApplication([])
@@ -1067,8 +2647,32 @@ if __name__ == "__main__":
         
     imageWidget.setOptions(options)
        
-    # Show
-    imageWidget.setPaths(paths)
+    if archive is not None:
+        paths = archive.imagePaths()
+        if args.random:
+            import random
+            random.shuffle(paths)
+        imageWidget.setPaths(paths, loader=archive)
+        widget.show()
+        imageWidget.setFocus(Qt.ActiveWindowFocusReason)
+        app.exec_()
+        imageWidget.shutdown()
+        archive.close()
+        sys.exit(0)
+        
+    # Show and load paths in the background
     widget.show()
     imageWidget.setFocus(Qt.ActiveWindowFocusReason)
+    scanner = DirectoryScanner(folder, args.recursive)
+    if args.random:
+        import random
+        def handlePathsFound(paths):
+            # Paths arrive in batches. Inserting each one at a random position shuffles all of them.
+            for path in paths:
+                imageWidget.insertPaths(random.randint(0, imageWidget.count()), [path])
+        scanner.pathsFound.connect(handlePathsFound)
+    else: scanner.pathsFound.connect(imageWidget.appendPaths)
+    scanner.start()
     app.exec_()
+    scanner.stop()
+    scanner.wait()
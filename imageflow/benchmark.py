@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# PyQt ImageFlow
+# Copyright (C) 2013-2014 Martin Altmayer <martin.altmayer@web.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Benchmarks for the image flow. Run
+python3 -m imageflow.benchmark --help
+to see the available arguments. The benchmarks run without a display (QT_QPA_PLATFORM=offscreen, unless
+another platform is set) on synthetic images and print their results as JSON, so that runs with different
+versions can be compared.
+"""
+import os, sys, time, json, shutil, tempfile, platform
+
+try:
+    import resource
+except ImportError:
+    resource = None # not available on Windows
+
+from . import QtCore, QtGui, QtWidgets
+from . import CURVES, STATE_READY, OPTIONS, Image, ImageFlowWidget, Metrics
+
+
+def createImages(directory, count, width, height):
+    """Create *count* JPEG images of the given size in *directory* and return their paths. The images
+    contain gradients and shapes, so that decoding them is about as expensive as decoding photos."""
+    paths = []
+    for i in range(count):
+        image = QtGui.QImage(width, height, QtGui.QImage.Format_RGB32)
+        gradient = QtGui.QLinearGradient(0, 0, width, height)
+        gradient.setColorAt(0, QtGui.QColor.fromHsv((i*37) % 360, 200, 230))
+        gradient.setColorAt(1, QtGui.QColor.fromHsv((i*37+180) % 360, 200, 80))
+        painter = QtGui.QPainter(image)
+        painter.fillRect(image.rect(), gradient)
+        painter.setRenderHint(QtGui.QPainter.Antialiasing)
+        for j in range(20):
+            painter.setBrush(QtGui.QColor.fromHsv((i*37+j*53) % 360, 150, 255, 160))
+            size = min(width, height) // 4
+            painter.drawEllipse((i*131 + j*197) % width - size//2, (i*71 + j*113) % height - size//2,
+                                size, size)
+        painter.end()
+        path = os.path.join(directory, 'image{:05d}.jpg'.format(i))
+        image.save(path, 'JPG', 90)
+        paths.append(path)
+    return paths
+
+
+def defaultOptions():
+    """Return a dict with the default value of every option."""
+    return {option: default for option, (optionType, default, _) in OPTIONS.items()}
+
+
+def benchmarkCreateCache(paths, reflection):
+    """Measure how fast Image.createCache creates the caches for the images at *paths*."""
+    options = defaultOptions()
+    options['reflection'] = reflection
+    metrics = Metrics()
+    startTime = time.perf_counter()
+    for path in paths:
+        imageStart = time.perf_counter()
+        Image(path=path).createCache(options, metrics=metrics)
+        metrics.record('createCache', (time.perf_counter() - imageStart) * 1000)
+    total = time.perf_counter() - startTime
+    summary = metrics.summary()
+    return {'reflection': reflection,
+            'imagesPerSecond': len(paths) / total,
+            'createCache': summary['createCache'],
+            'decodeTime': summary['decodeTime'],
+            'scaleTime': summary['scaleTime']}
+
+
+def benchmarkRender(paths, curve, reflection, fadeOut, frames, size):
+    """Measure the time Renderer.render needs for one frame during an animation over all images. All
+    caches are created and converted into pixmaps (as Renderer.convertCaches does after painting) before the
+    measurement starts."""
+    widget = ImageFlowWidget(loadAsync=False)
+    widget.resize(size)
+    widget.setOptions({'curve': curve, 'reflection': reflection, 'fadeOut': fadeOut})
+    # A plain list instead of an ImageList (setPaths), which would release caches of far away images
+    widget.setImages([Image(path=path) for path in paths])
+    options = widget.options()
+    for image in widget.images:
+        image.createCache(options, generation=widget._generation)
+        image.convert()
+    renderer = widget.renderer
+    renderer.init()
+
+    metrics = Metrics()
+    last = len(paths) - 1
+    for frame in range(frames):
+        # Move back and forth over all images in steps that hit fractional positions
+        pos = (frame * 0.13) % (2 * last) if last > 0 else 0
+        widget._pos = pos if pos <= last else 2 * last - pos
+        startTime = time.perf_counter()
+        renderer.render()
+        metrics.record('frameTime', (time.perf_counter() - startTime) * 1000)
+    widget.shutdown()
+    return {'curve': curve, 'reflection': reflection, 'fadeOut': fadeOut,
+            'frameTime': metrics.summary()['frameTime']}
+
+
+def benchmarkFirstImage(app, paths, threads, size, timeout=60):
+    """Measure how long the Worker needs until the central image and until all visible images are
+    loaded after ImageFlowWidget.setPaths."""
+    widget = ImageFlowWidget()
+    widget.resize(size)
+    widget.setOption('threads', threads)
+    widget.show()
+    app.processEvents()
+
+    startTime = time.perf_counter()
+    widget.setPaths(paths)
+    firstImage = allVisible = None
+    while time.perf_counter() - startTime < timeout:
+        app.processEvents(QtCore.QEventLoop.AllEvents, 5)
+        now = time.perf_counter() - startTime
+        if firstImage is None and widget.currentImage().state == STATE_READY:
+            firstImage = now
+        start, _, stop = widget.renderer.layout.visibleRange()
+        if all(widget.images[i].state == STATE_READY for i in range(start, stop)):
+            allVisible = now
+            break
+    widget.shutdown()
+    widget.worker.wait()
+    widget.hide()
+    return {'threads': threads,
+            'firstImage': firstImage * 1000 if firstImage is not None else None,
+            'allVisible': allVisible * 1000 if allVisible is not None else None}
+
+
+def peakMemory():
+    """Return the peak resident memory of this process in bytes or None if it cannot be determined."""
+    if resource is None:
+        return None
+    maxRss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxRss if sys.platform == 'darwin' else maxRss * 1024
+
+
+def run(args):
+    """Run all benchmarks selected by *args* (see main) and return the results as dict."""
+    app = QtWidgets.QApplication.instance() or QtWidgets.QApplication([])
+    size = QtCore.QSize(args.widgetWidth, args.widgetHeight)
+    curves = [key for title, key in CURVES] if args.curve is None else [args.curve]
+    results = {'config': {'count': args.count, 'width': args.width, 'height': args.height,
+                          'frames': args.frames, 'widgetSize': [size.width(), size.height()],
+                          'python': platform.python_version(), 'qt': QtCore.QT_VERSION_STR,
+                          'pyqt': QtCore.PYQT_VERSION_STR,
+                          'platform': app.platformName()}}
+
+    directory = tempfile.mkdtemp(prefix='imageflow-benchmark-')
+    try:
+        startTime = time.perf_counter()
+        paths = createImages(directory, args.count, args.width, args.height)
+        results['config']['createImagesTime'] = (time.perf_counter() - startTime) * 1000
+
+        if 'cache' in args.benchmarks:
+            results['createCache'] = [benchmarkCreateCache(paths, reflection) for reflection in (False, True)]
+        if 'render' in args.benchmarks:
+            results['render'] = [benchmarkRender(paths, curve, reflection, fadeOut, args.frames, size)
+                                 for curve in curves for reflection in (False, True)
+                                 for fadeOut in (False, True)]
+        if 'worker' in args.benchmarks:
+            results['worker'] = [benchmarkFirstImage(app, paths, threads, size) for threads in (1, 0)]
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    results['peakMemory'] = peakMemory()
+    return results
+
+
+def main():
+    import argparse
+    os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen')
+    parser = argparse.ArgumentParser(description="Run image flow benchmarks and print the results as JSON.")
+    parser.add_argument('--count', type=int, default=50, help="Number of synthetic images")
+    parser.add_argument('--width', type=int, default=1600, help="Width of synthetic images")
+    parser.add_argument('--height', type=int, default=1200, help="Height of synthetic images")
+    parser.add_argument('--frames', type=int, default=200, help="Number of frames rendered per configuration")
+    parser.add_argument('--widget-width', dest='widgetWidth', type=int, default=1400)
+    parser.add_argument('--widget-height', dest='widgetHeight', type=int, default=600)
+    parser.add_argument('--curve', choices=[key for title, key in CURVES],
+                        help="Only benchmark rendering with this curve")
+    parser.add_argument('--benchmarks', nargs='+', choices=['cache', 'render', 'worker'],
+                        default=['cache', 'render', 'worker'], help="Benchmarks to run (default: all)")
+    parser.add_argument('--output', help="Write results to this file instead of stdout")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.output is not None:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else: print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,280 @@
+# -*- coding: utf-8 -*-
+# PyQt ImageFlow
+# Copyright (C) 2013-2014 Martin Altmayer <martin.altmayer@web.de>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+"""Loaders for images that are not stored in local files (see imageflow.Loader). Use them like this:
+
+    loader = HttpLoader('http://example.com/thumbnails/')
+    widget.setPaths(['1.jpg', '2.jpg'], loader=loader)
+    
+    loader = ArchiveLoader('comic.cbz')
+    widget.setPaths(loader.imagePaths(), loader=loader)
+"""
+import os, re, asyncio, collections, concurrent.futures, ssl, threading, urllib.parse, zipfile
+
+from . import Loader, LoadCancelled, TemporaryLoadError, DirectoryScanner
+
+
+class HttpLoader(Loader):
+    """Loads images via HTTP(S) GET requests. The paths of images are URLs, relative to *baseUrl* if it is
+    given. Requests are performed by an asyncio event loop in a separate thread: When the Worker's load list
+    changes, all requested images are fetched in advance, but at most *maxConnections* at the same time.
+    Fetches of images that are not requested anymore are cancelled. Connections are kept alive and reused.
+    *headers* may contain additional HTTP headers (e.g. for authorization) and *timeout* is the maximal
+    time in seconds for a single request.
+    Timeouts, connection errors and the status codes in TEMPORARY_STATUS raise TemporaryLoadError, so that
+    the image is loaded again later. Other status codes let the image fail.
+    """
+    # HTTP status codes that indicate a temporary problem
+    TEMPORARY_STATUS = (408, 429, 500, 502, 503, 504)
+    
+    def __init__(self, baseUrl=None, maxConnections=6, timeout=30, headers=None):
+        self.baseUrl = baseUrl
+        self.maxConnections = maxConnections
+        self.timeout = timeout
+        self.headers = headers or {}
+        self._lock = threading.Lock()
+        self._futures = {} # maps images to concurrent.futures.Future-instances of running fetches
+        self._fetched = set() # requested images that have been handed to fetch; they are not fetched again
+        self._loop = None
+        self._thread = None
+        self._semaphore = None
+        self._connections = collections.defaultdict(list) # maps (scheme, host, port) to idle connections
+
+    def url(self, image):
+        """Return the URL of the given image."""
+        if self.baseUrl is not None:
+            return urllib.parse.urljoin(self.baseUrl, image.path)
+        else: return image.path
+
+    def cacheKey(self, image):
+        return self.url(image)
+
+    def request(self, images):
+        with self._lock:
+            requested = set(images)
+            for image in [image for image in self._futures if image not in requested]:
+                self._futures.pop(image).cancel()
+            # Images that have been fetched remain in the load list until their cache has been created
+            self._fetched.intersection_update(requested)
+            for image in images:
+                if image not in self._futures and image not in self._fetched:
+                    self._futures[image] = self._submit(image)
+
+    def fetch(self, image):
+        with self._lock:
+            future = self._futures.get(image)
+            if future is None:
+                future = self._futures[image] = self._submit(image)
+            self._fetched.add(image)
+        try:
+            return future.result()
+        except concurrent.futures.CancelledError:
+            raise LoadCancelled()
+        finally:
+            with self._lock:
+                if self._futures.get(image) is future:
+                    del self._futures[image]
+
+    def close(self):
+        with self._lock:
+            for future in self._futures.values():
+                future.cancel()
+            self._futures = {}
+            self._fetched = set()
+            if self._loop is not None:
+                asyncio.run_coroutine_threadsafe(self._shutdown(), self._loop).result()
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join()
+                self._loop.close()
+                self._loop = self._thread = None
+
+    def _submit(self, image):
+        """Start fetching *image* and return a concurrent.futures.Future. The lock must be held."""
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+            self._thread = threading.Thread(target=self._loop.run_forever, name='HttpLoader', daemon=True)
+            self._thread.start()
+            self._semaphore = asyncio.run_coroutine_threadsafe(self._createSemaphore(), self._loop).result()
+        return asyncio.run_coroutine_threadsafe(self._get(self.url(image)), self._loop)
+
+    async def _createSemaphore(self):
+        # Create the semaphore within the event loop (required by Python < 3.10)
+        return asyncio.Semaphore(self.maxConnections)
+
+    async def _shutdown(self):
+        """Cancel all fetches, wait until they have finished and close all idle connections."""
+        tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for connections in self._connections.values():
+            for reader, writer in connections:
+                writer.close()
+        self._connections.clear()
+
+    async def _get(self, url):
+        """Return the body of a GET request for *url*. Raise TemporaryLoadError if the request fails
+        temporarily and OSError if it fails permanently."""
+        parts = urllib.parse.urlsplit(url)
+        if parts.scheme not in ('http', 'https') or not parts.hostname:
+            raise OSError("Unsupported URL: {}".format(url))
+        key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        target = parts.path or '/'
+        if parts.query:
+            target += '?' + parts.query
+        async with self._semaphore:
+            # If a reused connection has been closed by the server in the meantime, try again once
+            for attempt in range(2):
+                try:
+                    reader, writer, reused = await self._connect(key)
+                except (OSError, asyncio.TimeoutError) as e:
+                    raise TemporaryLoadError("Cannot connect to {}: {}".format(url, str(e) or type(e).__name__))
+                try:
+                    status, keepAlive, body = await asyncio.wait_for(
+                                                    self._exchange(reader, writer, parts.netloc, target),
+                                                    self.timeout)
+                except asyncio.CancelledError:
+                    writer.close()
+                    raise
+                except (OSError, EOFError, ValueError, asyncio.TimeoutError) as e:
+                    writer.close()
+                    if reused and attempt == 0:
+                        continue
+                    raise TemporaryLoadError("Cannot load {}: {}".format(url, str(e) or type(e).__name__))
+                if keepAlive:
+                    self._connections[key].append((reader, writer))
+                else: writer.close()
+                if status in self.TEMPORARY_STATUS:
+                    raise TemporaryLoadError("Cannot load {}: HTTP status {}".format(url, status))
+                elif status != 200:
+                    raise OSError("Cannot load {}: HTTP status {}".format(url, status))
+                return body
+
+    async def _connect(self, key):
+        """Return a tuple (reader, writer, reused) for a connection to the server given by *key*. Idle
+        connections are reused if possible."""
+        connections = self._connections[key]
+        while len(connections) > 0:
+            reader, writer = connections.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return reader, writer, True
+            writer.close()
+        scheme, host, port = key
+        reader, writer = await asyncio.wait_for(
+                            asyncio.open_connection(host, port,
+                                                    ssl=ssl.create_default_context() if scheme == 'https' else None),
+                            self.timeout)
+        return reader, writer, False
+
+    async def _exchange(self, reader, writer, host, target):
+        """Send a GET request for *target* and return a tuple (status, keepAlive, body)."""
+        lines = ['GET {} HTTP/1.1'.format(target), 'Host: {}'.format(host), 'Connection: keep-alive']
+        lines.extend('{}: {}'.format(name, value) for name, value in self.headers.items())
+        writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1'))
+        await writer.drain()
+
+        statusLine = await reader.readline()
+        if not statusLine:
+            raise EOFError("Connection closed")
+        version, status = statusLine.decode('latin-1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n'):
+                break
+            if not line:
+                raise EOFError("Connection closed")
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keepAlive = version != 'HTTP/1.0' and headers.get('connection', '').lower() != 'close'
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    while (await reader.readline()) not in (b'\r\n', b'\n', b''): # skip trailers
+                        pass
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readexactly(2) # CRLF
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:
+            body = await reader.read()
+            keepAlive = False
+        return int(status), keepAlive, body
+
+
+class ArchiveLoader(Loader):
+    """Loads images from a ZIP archive (e.g. a CBZ file) without extracting it. The paths of images are the
+    names of archive members, see imagePaths. The central directory is only read once and the archive is
+    opened only once, even if several loaders are created for the same file. Members are only read and
+    decompressed when the Worker needs them (decompression runs in parallel if the option 'threads' is
+    larger than 1).
+    """
+    # maps absolute paths to [ZipFile, number of loaders using it]; protected by _archivesLock
+    _archives = {}
+    _archivesLock = threading.Lock()
+    
+    def __init__(self, path, extensions=DirectoryScanner.EXTENSIONS):
+        self.path = os.path.abspath(path)
+        self.extensions = tuple(extension.lower() for extension in extensions)
+        with self._archivesLock:
+            entry = self._archives.get(self.path)
+            if entry is None:
+                entry = self._archives[self.path] = [zipfile.ZipFile(self.path), 0]
+            entry[1] += 1
+        self._zipFile = entry[0]
+        
+    def imagePaths(self):
+        """Return the names of all images in the archive in natural order (i.e. 'page2' before 'page10')."""
+        names = [info.filename for info in self._zipFile.infolist()
+                 if not info.is_dir() and os.path.splitext(info.filename)[1].lower() in self.extensions]
+        return sorted(names, key=lambda name: [int(part) if part.isdigit() else part.lower()
+                                               for part in re.split(r'(\d+)', name)])
+    
+    def fetch(self, image):
+        zipFile = self._zipFile
+        if zipFile is None:
+            raise OSError("Archive {} has been closed".format(self.path))
+        try:
+            # ZipFile synchronizes access to the shared file handle; decompression runs in parallel
+            return zipFile.read(image.path)
+        except (KeyError, zipfile.BadZipFile, RuntimeError) as e:
+            raise OSError("Cannot load {} from {}: {}".format(image.path, self.path, e))
+    
+    def cacheKey(self, image):
+        if self._zipFile is None:
+            return None
+        try:
+            info = self._zipFile.getinfo(image.path)
+        except KeyError:
+            return None
+        return 'zip:{}:{}:{}:{}'.format(self.path, image.path, info.CRC, info.file_size)
+        
+    def close(self):
+        with self._archivesLock:
+            if self._zipFile is None:
+                return
+            entry = self._archives[self.path]
+            entry[1] -= 1
+            if entry[1] == 0:
+                entry[0].close()
+                del self._archives[self.path]
+            self._zipFile = None